@@ -0,0 +1,278 @@
+'''
+Where VoiceTriggerController gets its audio from.
+
+PyAudioSource is the microphone, as before.  WavSource plays back a recording
+and SyntheticSource makes up a noisy signal with utterances at known onsets,
+so the voice trigger can be tested and benchmarked without any sound hardware
+(see benchmarks/bench_voicetrigger.py).  Both of those can run in real time,
+or as fast as they're read (realtime=False), in which case their clock is
+just the number of samples read so far.
+
+A source has the same methods as the PyAudio stream the controller used to
+use directly:
+
+    open(rate, chunk_size, callback=None, channels=1) - get it ready.  If
+        callback is given, it'll be called from a thread with each chunk,
+        like PyAudio's callback mode (with the same arguments and flags)
+    start() - start capturing (and calling callback).  This is separate
+        from open, so everything callback needs can be set up in between
+    read(n) - the next n frames (of all channels, interleaved), as int16
+        bytes (blocking mode)
+    get_time() - the stream clock, in seconds
+    get_input_latency() - seconds from the ADC to us
+    close()
+
+and sample_width, the bytes per sample.
+
+'''
+
+import threading
+import time
+import wave
+
+import numpy as np
+
+# These are PortAudio's values, so PyAudioSource can pass its own through
+CONTINUE = 0  # callback return flag
+INPUT_OVERFLOW = 2  # callback status flag
+INPUT_OVERFLOWED = -9981  # error number for an overflowed blocking read
+
+
+class PyAudioSource(object):
+    ''' A live input stream from PyAudio (16 bit).  pyaudio is only imported
+    when this is opened.
+    '''
+    sample_width = 2
+
+    def __init__(self, input_device_index=None):
+        self.input_device_index = input_device_index
+        self.pa = None
+        self.stream = None
+
+    def open(self, rate, chunk_size, callback=None, channels=1):
+        import pyaudio
+        self.pa = pyaudio.PyAudio()
+        self.sample_width = self.pa.get_sample_size(pyaudio.paInt16)
+        self.stream = self.pa.open(format=pyaudio.paInt16, channels=channels,
+                                   rate=rate,
+                                   input=True, output=False,
+                                   input_device_index=self.input_device_index,
+                                   frames_per_buffer=chunk_size,
+                                   stream_callback=callback,
+                                   start=False)
+
+    def start(self):
+        self.stream.start_stream()
+
+    def read(self, n):
+        return self.stream.read(n)
+
+    def get_time(self):
+        return self.stream.get_time()
+
+    def get_input_latency(self):
+        return self.stream.get_input_latency()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.pa.terminate()
+            self.stream = None
+
+
+class SimulatedSource(object):
+    ''' Plays back data, an int16 array (a column for each channel, or 1-d
+    for mono) recorded at rate - or silence, if there's no data.  WavSource
+    and SyntheticSource are built on this, and override samples(start, n)
+    to give (n, channels) arrays from elsewhere.
+
+    With realtime=True, reads (and callbacks) are paced by the wall clock.
+    Otherwise they happen as fast as they're asked for, and get_time() is the
+    number of samples read, in seconds.  Once there's nothing left, we give
+    silence (or start again, with loop=True) and set finished.
+    '''
+    sample_width = 2
+    realtime = True
+    latency = 0.0  # pretend input latency, in seconds
+    rate = None
+    channels = None
+    length = None  # in samples, None for no end
+    data = None
+    loop = False
+
+    def __init__(self, data=None, rate=None, realtime=True, latency=0.0,
+                 loop=False):
+        self.realtime = realtime
+        self.latency = latency
+        self.position = 0  # samples read so far
+        self.start_time = None
+        self.finished = False
+        self.thread = None
+        self.callback = None
+        self.running = False
+        if rate is not None:
+            self.rate = rate
+        if data is not None:
+            self.set_data(data, loop)
+
+    def set_data(self, data, loop=False):
+        data = np.asarray(data, dtype=np.int16)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        self.data = data
+        self.channels = data.shape[1]
+        self.loop = loop
+        if not loop:
+            self.length = len(data)
+
+    def samples(self, start, n):
+        ''' int16 samples start:start + n (zeros past the end) '''
+        if self.data is None:
+            return np.zeros((n, self.channels), dtype=np.int16)
+        if self.loop:
+            return np.take(self.data, np.arange(start, start + n), axis=0,
+                           mode='wrap')
+        out = np.zeros((n, self.channels), dtype=np.int16)
+        chunk = self.data[start:start + n]
+        out[:len(chunk)] = chunk
+        return out
+
+    def open(self, rate, chunk_size, callback=None, channels=1):
+        if self.rate is None:
+            self.rate = rate
+        elif self.rate != rate:
+            raise ValueError('source is at %d Hz, not %d' % (self.rate, rate))
+        if self.channels is None:
+            self.channels = channels
+        elif self.channels != channels:
+            raise ValueError('source has %d channels, not %d' %
+                             (self.channels, channels))
+        self.chunk_size = chunk_size
+        self.callback = callback
+
+    def start(self):
+        self.start_time = time.time()
+        if self.callback is not None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run,
+                                           args=(self.callback, ))
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def next_chunk(self, n):
+        ''' Returns the next n samples, after waiting for them if realtime '''
+        start = self.position
+        if self.realtime:
+            wait = self.start_time + float(start + n) / self.rate - \
+                time.time()
+            if wait > 0:
+                time.sleep(wait)
+        chunk = self.samples(start, n)
+        self.position = start + n
+        if self.length is not None and self.position >= self.length:
+            self.finished = True
+        return chunk
+
+    def run(self, callback):
+        while self.running:
+            start = self.position
+            data = self.next_chunk(self.chunk_size).astype('<i2').tostring()
+            time_info = {'input_buffer_adc_time':
+                             float(start) / self.rate - self.latency,
+                         'current_time': self.get_time()}
+            flag = callback(data, self.chunk_size, time_info, 0)[1]
+            if flag != CONTINUE:
+                break
+
+    def read(self, n):
+        return self.next_chunk(n).astype('<i2').tostring()
+
+    def get_time(self):
+        if self.realtime:
+            return time.time() - self.start_time
+        return float(self.position) / self.rate
+
+    def get_input_latency(self):
+        return self.latency
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class WavSource(SimulatedSource):
+    ''' Plays back a 16 bit WAV file '''
+
+    def __init__(self, fname, realtime=True, latency=0.0, loop=False):
+        wf = wave.open(fname, 'rb')
+        if wf.getsampwidth() != 2:
+            raise ValueError('%s is not 16 bit' % fname)
+        rate = wf.getframerate()
+        data = np.frombuffer(wf.readframes(wf.getnframes()),
+                             dtype='<i2').reshape(-1, wf.getnchannels())
+        wf.close()
+        SimulatedSource.__init__(self, data, rate, realtime, latency, loop)
+
+
+class SyntheticSource(SimulatedSource):
+    ''' Noise (mains hum and hiss) with "utterances" - bursts of a harmonic
+    complex, like a voiced sound - at known times.
+
+    utterances is a list of (onset, duration) in seconds, or (onset,
+    duration, amplitude), or (onset, duration, amplitude, channel) - they're
+    on channel 0 otherwise.  Each channel has its own hiss.  duration is
+    the total length of the signal, in
+    seconds (None for no end).  Everything is generated a chunk at a time, and
+    the same seed gives the same signal.
+    '''
+
+    def __init__(self, rate=44100, utterances=(), duration=None,
+                 amplitude=3000, hum=200, hiss=50, f0=150., channels=1,
+                 realtime=False, latency=0.0, seed=0):
+        SimulatedSource.__init__(self, None, rate, realtime, latency)
+        self.channels = channels
+        self.utterances = []
+        for u in sorted(utterances):
+            u = tuple(u)
+            if len(u) == 2:
+                u += (amplitude, )
+            if len(u) == 3:
+                u += (0, )
+            self.utterances.append(u)
+        if duration is not None:
+            self.length = int(duration * rate)
+        self.hum = hum
+        self.hiss = hiss
+        self.f0 = f0
+        self.seed = seed
+
+    def onsets(self, channel=None):
+        ''' The utterance onsets, in samples (on one channel, or all) '''
+        return [int(u[0] * self.rate) for u in self.utterances
+                if channel is None or u[3] == channel]
+
+    def samples(self, start, n):
+        t = np.arange(start, start + n) / float(self.rate)
+        # seeded by position, so it doesn't matter who reads first
+        rng = np.random.RandomState((self.seed, start % 2**32))
+        sig = rng.normal(0, self.hiss, (n, self.channels))
+        sig += (self.hum * np.sin(2 * np.pi * 60 * t))[:, np.newaxis]
+
+        for onset, duration, amplitude, channel in self.utterances:
+            if onset >= t[-1] or onset + duration <= t[0]:
+                continue
+            tt = t - onset
+            on = (tt >= 0) & (tt < duration)
+            tt = tt[on]
+            voice = sum(np.sin(2 * np.pi * self.f0 * h * tt) / h
+                        for h in range(1, 8))
+            # 10 ms ramps, so the onset is sharp but not a click
+            envelope = np.minimum(1, np.minimum(tt, duration - tt) / 0.01)
+            sig[on, channel] += amplitude * voice * envelope
+
+        if self.length is not None and start + n > self.length:
+            sig[max(0, self.length - start):] = 0
+        return np.clip(sig, -32768, 32767).astype(np.int16)
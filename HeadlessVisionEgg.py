@@ -0,0 +1,276 @@
+"""A stand-in for SimpleVisionEgg that runs a StimController with no display,
+on a synthetic clock.  Useful for checking the timing logic and log output of
+an experiment (lots of times, in CI, with scripted or random responses) without
+sitting in front of it.
+
+Frames are generated as fast as the CPU allows, with t advancing by exactly
+1 / frame_rate each frame.  While running, pygame.event is swapped for a
+SimulatedEventQueue, so Responses see the events that a responder posts.
+
+Usage is the same as with SimpleVisionEgg, e.g.:
+
+    vision_egg = HeadlessVisionEgg(frame_rate=60)
+    vision_egg.set_stimuli(stimuli)
+    stim_control = StimController(trials, vision_egg)
+    vision_egg.respond = SimulatedResponder(stim_control, rt=0.4)
+    stim_control.run_trials(len(trials))
+    stim_control.writelog('sim.csv')
+
+Your stimuli can't be real VisionEgg stimuli (they need an OpenGL context),
+use HeadlessStimulus instead.  SyntheticInputSource can feed scripted events
+to a StimController.InputThread.
+"""
+
+from timeit import default_timer as clock
+
+import pygame
+
+# key_code works without a display, unlike pygame.key.name
+from cognac.StimController import ActiveStimuli, key_code
+
+
+class HeadlessStimulus:
+    """Stands in for a VisionEgg stimulus - it just keeps track of the
+    parameters that get set on it."""
+    parameters = None
+
+    def __init__(self, **parms):
+        self.parameters = HeadlessParameters()
+        parms.setdefault('on', False)
+        self.set(**parms)
+
+    def set(self, **parms):
+        self.parameters.__dict__.update(parms)
+
+
+class HeadlessParameters:
+    """Plain attribute holder, like VisionEgg's parameter objects"""
+    pass
+
+
+class HeadlessViewport:
+    """Holds the stimuli to draw, like a VisionEgg Viewport"""
+    parameters = None
+
+    def __init__(self, stimuli):
+        self.parameters = HeadlessParameters()
+        self.parameters.stimuli = stimuli
+
+    def draw(self):
+        """Walk through the stimuli as VisionEgg does (each stimulus checks
+        whether it's on), returning how many are on"""
+        drawn = 0
+        for stimulus in self.parameters.stimuli:
+            if stimulus.parameters.on:
+                drawn += 1
+        return drawn
+
+
+class SimulatedEventQueue:
+    """Implements the bits of pygame.event that cognac uses, without needing a
+    display (pygame's own queue needs the video system initialized)."""
+    # We still use pygame's Event objects, those work without a display
+    Event = pygame.event.Event
+    queue = None
+
+    def __init__(self):
+        self.queue = []
+
+    def post(self, event):
+        self.queue.append(event)
+
+    def get(self, eventtype=None):
+        if eventtype is None:
+            events = self.queue
+            self.queue = []
+            return events
+
+        if not isinstance(eventtype, (list, tuple)):
+            eventtype = (eventtype, )
+        events = [e for e in self.queue if e.type in eventtype]
+        if events:
+            self.queue = [e for e in self.queue if e.type not in eventtype]
+        return events
+
+    def clear(self, eventtype=None):
+        self.get(eventtype)
+
+    def peek(self, eventtype=None):
+        if eventtype is None:
+            return bool(self.queue)
+        if not isinstance(eventtype, (list, tuple)):
+            eventtype = (eventtype, )
+        for e in self.queue:
+            if e.type in eventtype:
+                return True
+        return False
+
+
+class SimulatedResponder:
+    """Answers whichever Response is currently waiting in stim_controller.
+
+    rt : number, or callable taking the Response and returning a number
+        Seconds after the start of the response period to respond.  If it
+        returns None, we don't respond (e.g., to simulate misses)
+    key : key name, or callable taking the Response and returning one
+        Defaults to the Response's expected key, or the first in its limit
+    attrs : dict
+        Extra attributes for the posted events (e.g., VoiceResponse wants a
+        filename)
+
+    For stochastic responses, pass callables, e.g.:
+        rt=lambda r: random.gauss(0.5, 0.1)
+    """
+    stim_controller = None
+    rt = None
+    key = None
+    attrs = None
+
+    # The Response we're currently dealing with, and when we'll respond
+    curr_response = None
+    due = None
+
+    def __init__(self, stim_controller, rt=0.5, key=None, attrs=None):
+        self.stim_controller = stim_controller
+        self.rt = rt
+        self.key = key
+        self.attrs = attrs or {}
+
+    def choose_key(self, response):
+        key = self.key
+        if callable(key):
+            key = key(response)
+        if key is None:
+            if response.expected is not None:
+                key = response.expected
+            elif response.limit:
+                key = response.limit[0]
+            else:
+                key = 'space'
+        return key
+
+    def __call__(self, t, event_queue):
+        sc = self.stim_controller
+        response = sc.trials[sc.trial_index].curr_response
+        if response is None or response.ref_time is None:
+            return
+
+        if response is not self.curr_response:
+            self.curr_response = response
+            self.due = self.rt(response) if callable(self.rt) else self.rt
+
+        if self.due is not None and t - response.ref_time >= self.due:
+            self.due = None
+            attrs = dict(self.attrs)
+            if response.response_type in (pygame.KEYDOWN, pygame.KEYUP):
+                attrs['key'] = key_code(self.choose_key(response))
+            event_queue.post(event_queue.Event(response.response_type, attrs))
+
+
+class SyntheticInputSource:
+    """An input source for StimController.InputThread that produces scripted
+    events, for testing sub-frame timestamping without any hardware.
+
+    script is a list of (seconds after the first poll, event).  Note that the
+    InputThread runs in real time, not on HeadlessVisionEgg's synthetic clock.
+    """
+    script = None
+    start = None
+    # index of the next event in script
+    next = 0
+
+    def __init__(self, script):
+        self.script = sorted(script, key=lambda item: item[0])
+
+    def poll(self):
+        now = clock()
+        if self.start is None:
+            self.start = now
+
+        due = []
+        script = self.script
+        while self.next < len(script) and \
+                script[self.next][0] <= now - self.start:
+            due.append(script[self.next][1])
+            self.next += 1
+        return due
+
+
+class HeadlessVisionEgg:
+    """Has the same interface as SimpleVisionEgg, as far as StimController is
+    concerned."""
+    frame_rate = 60.0
+    # Called as respond(t, event_queue) before every frame
+    respond = None
+    event_queue = None
+    stimuli = None
+    viewport = None
+    active_stimuli = None
+
+    update = None
+    pause_update = None
+    going = False
+    # Number of frames we've run, over all calls to go()
+    frame_count = 0
+
+    def __init__(self, frame_rate=None, respond=None):
+        if frame_rate is not None:
+            self.frame_rate = float(frame_rate)
+        self.respond = respond
+        self.event_queue = SimulatedEventQueue()
+        self.set_stimuli([])
+
+    def set_stimuli(self, stimuli, trigger=None, kb_controller=False,
+                    cull=False):
+        """We don't draw anything, but keep the stimuli for reference, and
+        walk through them each frame as VisionEgg would (including with
+        cull)"""
+        self.stimuli = stimuli
+        self.viewport = HeadlessViewport(stimuli)
+        if cull:
+            self.active_stimuli = ActiveStimuli(self.viewport, stimuli)
+        else:
+            self.active_stimuli = None
+
+    def set_functions(self, update=None, pause_update=None):
+        """Interface for cognac.StimulusController or similar"""
+        self.update = update
+        self.pause_update = pause_update
+
+    def go(self, go_duration=('forever',)):
+        """Run frames until pause() is called, or until go_duration (in
+        'seconds' or 'frames') is up.  Like VisionEgg, t starts over at 0 for
+        each go()."""
+        if go_duration[0] == 'forever':
+            max_frames = None
+        elif go_duration[1] == 'frames':
+            max_frames = go_duration[0]
+        else:
+            max_frames = int(go_duration[0] * self.frame_rate)
+
+        real_event = pygame.event
+        pygame.event = self.event_queue
+        try:
+            if self.pause_update:
+                self.pause_update()
+
+            self.going = True
+            frame = 0
+            while self.going and frame != max_frames:
+                t = frame / self.frame_rate
+                if self.respond:
+                    self.respond(t, self.event_queue)
+                if self.update:
+                    self.update(t)
+                self.viewport.draw()
+                frame += 1
+            self.frame_count += frame
+        finally:
+            pygame.event = real_event
+            self.going = False
+
+    def pause(self):
+        self.going = False
+
+    def quit(self):
+        self.going = False
@@ -2,7 +2,14 @@
 do.  This module serves simply to set things up and keep track of VisionEgg
 related values.  It shouldn't really _do_ anything."""
 
+import os
+import json
+import logging
+import platform
+from timeit import default_timer as clock
+
 import pygame
+import numpy as np
 
 import VisionEgg
 from VisionEgg.Core import get_default_screen, Viewport
@@ -11,6 +18,8 @@ from VisionEgg.ResponseControl import KeyboardResponseController
 from VisionEgg.DaqKeyboard import KeyboardTriggerInController
 from VisionEgg.ParameterTypes import NoneType
 
+from cognac.StimController import ActiveStimuli
+
 
 #################################
 # Set some VisionEgg Defaults:  #
@@ -20,6 +29,116 @@ VisionEgg.config.VISIONEGG_GUI_INIT = 0
 VisionEgg.config.VISIONEGG_GUI_ON_ERROR = 0
 VisionEgg.config.VISIONEGG_FULLSCREEN = 1 
 
+# What we've found out about this computer's display (see display_size)
+RIG_CONFIG = os.path.join(os.path.expanduser('~'), '.cognac_rig.json')
+
+def display_size(config_file=RIG_CONFIG, refresh=False):
+    """(width, height) of the display, in pixels.
+
+    Asks SDL for the current video mode, without opening a window, and keeps
+    the answer in config_file (under this computer's name), so next time we
+    don't even need to ask.  Use refresh=True if the display has changed.
+    config_file=None skips the cache.  If config_file can't be written (e.g.,
+    the home directory is read-only), we warn, and go on without it.
+    """
+    rig = platform.node()
+    config = {}
+    if config_file is not None and os.path.exists(config_file):
+        try:
+            with open(config_file) as f:
+                config = json.load(f)
+        except (ValueError, IOError):  # we'll just write a new one
+            config = {}
+    if not refresh and 'screen_size' in config.get(rig, {}):
+        return tuple(config[rig]['screen_size'])
+
+    pygame.display.init()
+    info = pygame.display.Info()
+    size = (info.current_w, info.current_h)
+    if size[0] <= 0 or size[1] <= 0:
+        # Old versions of pygame / SDL don't tell us, so we have to open a
+        # window to find out
+        size = pygame.display.set_mode((0, 0)).get_size()
+    pygame.display.quit()  # so VisionEgg can start it up its own way
+
+    if config_file is not None:
+        config.setdefault(rig, {})['screen_size'] = size
+        tmp_name = config_file + '.tmp'
+        try:
+            with open(tmp_name, 'w') as tmp:
+                json.dump(config, tmp, indent=2, sort_keys=True)
+            os.rename(tmp_name, config_file)
+        except (IOError, OSError), e:
+            logging.getLogger('VisionEgg').warning(
+                'Could not save the display size to %s: %s' %
+                (config_file, e))
+    return size
+
+def onsets_offsets(responses, times, time_to_subtract=0, min_interval=2.0/60,
+                   structured=False):
+    """Turn VisionEgg's per-sample keyboard record into onsets and offsets.
+
+    responses and times are as from KeyboardResponseController's
+    get_responses_since_go() and get_time_responses_since_go() - a list of the
+    keys down (itself a list) for every sample, and the time of each sample.
+
+    A new run of key presses starts whenever the set of keys down changes, or
+    there's a gap of more than min_interval between samples.  By default, the
+    return value is (responses, times), alternating the onset of each run
+    (the keys down) with its offset (each key + '_Off'), times having
+    time_to_subtract subtracted.
+
+    With structured=True, you get a numpy structured array instead, with one
+    row (key, onset, offset) for each key in each run.
+
+    The work is done on numpy arrays of integer codes, so there's only one
+    pass in python (to hash each sample's keys).
+    """
+    # If I've only got one item in my response list, then it's silly to worry
+    # about onset/offset.  Just keep it.
+    if len(responses) < 2 and not structured:
+        return (responses, times)
+    if len(responses) == 0:
+        return np.array([], dtype=[('key', 'S1'), ('onset', float),
+                                   ('offset', float)])
+
+    # Give each distinct set of keys down an integer code
+    combos = {}
+    codes = np.array([combos.setdefault(tuple(r), len(combos))
+                      for r in responses], dtype=int)
+    times = np.asarray(times, dtype=float) - time_to_subtract
+
+    # Something changed, or we have a long gap
+    changes = np.flatnonzero((codes[1:] != codes[:-1]) |
+                             (np.diff(times) > min_interval)) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes - 1, [len(codes) - 1]))
+
+    if structured:
+        keys = dict((code, combo) for combo, code in combos.items())
+        rows = [(key, times[s], times[e]) 
+                for s, e in zip(starts, ends) for key in keys[codes[s]]]
+        width = max([len(r[0]) for r in rows] + [1])
+        return np.array(rows, dtype=[('key', 'S%d' % width),
+                                     ('onset', float), ('offset', float)])
+
+    goodResp = []
+    goodRespTime = []
+    onset_times = times[starts].tolist()
+    offset_times = times[ends].tolist()
+    last = len(starts) - 1
+    for i, start in enumerate(starts):
+        goodResp.append(responses[start])
+        goodRespTime.append(onset_times[i])
+        offsetResp = [item + '_Off' for item in responses[start]]
+        # The final event should always be an offset for whatever was down
+        if offsetResp or i == last:
+            goodResp.append(offsetResp)
+            goodRespTime.append(offset_times[i])
+
+    return (goodResp, goodRespTime)
+
+
 class MultiStimHelper:
     """Meant to be embedded in MultiStim"""
     stims = None
@@ -42,11 +161,17 @@ class MultiStim:
     parameters = None
 
     def __init__(self, *stims):
+        self.stims = stims
         self.parameters = MultiStimHelper(stims)
 
     def set(self, **parms):
-        for k, v in parms.items():
-            setattr(self.parameters, k, v)
+        # All the parameters for each stim in turn, rather than going through
+        # MultiStimHelper for each parameter
+        items = parms.items()
+        for s in self.stims:
+            params = s.parameters
+            for k, v in items:
+                setattr(params, k, v)
 
 class SimpleVisionEgg:
     keyboard_controller = None
@@ -56,31 +181,64 @@ class SimpleVisionEgg:
     keys = None
     presses = None
     releases = None
+    # Seconds spent on each part of __init__
+    startup_times = None
+    # With set_stimuli(cull=True)
+    active_stimuli = None
 
-    def __init__(self):
+    def __init__(self, fullscreen=True, rig_config=RIG_CONFIG,
+                 refresh_rig=False):
         """We break up initialization a bit as we need to go back and forth with
         some information.  In this case, we need screen size before specifying
-        the stimuli"""
+        the stimuli.
+
+        fullscreen sets VisionEgg's VISIONEGG_FULLSCREEN.  With it, the
+        screen is set to the display's size - which is found without opening
+        a window, and cached in rig_config (see display_size), so the display
+        only gets set up once, by VisionEgg.  Without it, you get a window of
+        VisionEgg's configured size.
+        How long it all took is logged, and kept in startup_times."""
+        start = clock()
         
         VisionEgg.start_default_logging()
         VisionEgg.watch_exceptions()
+        self.startup_times = {}
+
+        VisionEgg.config.VISIONEGG_FULLSCREEN = int(bool(fullscreen))
         # get screen size for setting fullscreen resolution
-        # comment this block out if you don't want to use full-screen.
-        screen = pygame.display.set_mode((0,0)) # this opens up a pygame window
-        WIDTH, HEIGHT = screen.get_size()
-        pygame.quit()  # close this pygame window, or else it interferes w/ VE
-        VisionEgg.config.VISIONEGG_SCREEN_W = WIDTH
-        VisionEgg.config.VISIONEGG_SCREEN_H = HEIGHT
+        if fullscreen:
+            WIDTH, HEIGHT = display_size(rig_config, refresh_rig)
+            VisionEgg.config.VISIONEGG_SCREEN_W = WIDTH
+            VisionEgg.config.VISIONEGG_SCREEN_H = HEIGHT
+        self.startup_times['display_size'] = clock() - start
 
+        screen_start = clock()
         self.screen = get_default_screen()
+        self.startup_times['screen'] = clock() - screen_start
+        self.startup_times['total'] = clock() - start
+        logging.getLogger('VisionEgg').info(
+            'SimpleVisionEgg started in %(total).2f s (display size '
+            '%(display_size).2f s, screen %(screen).2f s)' % self.startup_times)
+
         self.keys = []
         self.presses = []
         self.releases = []
 
-    def set_stimuli(self, stimuli, trigger=None, kb_controller=False):
-        """Now that we have our stimuli, we initialize everything we can"""
+    def set_stimuli(self, stimuli, trigger=None, kb_controller=False,
+                    cull=False):
+        """Now that we have our stimuli, we initialize everything we can
+
+        With cull=True, the viewport only gets the stimuli that are on (see
+        StimController.ActiveStimuli), so drawing each frame takes time in
+        proportion to what's on the screen, not to all the stimuli in the
+        experiment.  Stimuli must then be turned on and off by Events."""
         viewport = Viewport(screen=self.screen, size=self.screen.size, 
                            stimuli=stimuli)
+        # Replacing any from before - StimController only uses the latest
+        if cull:
+            self.active_stimuli = ActiveStimuli(viewport, stimuli)
+        else:
+            self.active_stimuli = None
 
         # We disable "check_events" so that we don't lose "instantaneous" key
         # presses and can check these in our Response classes
@@ -211,50 +369,5 @@ class SimpleVisionEgg:
         response = self.keyboard_controller.get_responses_since_go()
         responseTime = self.keyboard_controller.get_time_responses_since_go()
 
-        # If I've only got one item in my response list, then it's silly to worry about onset/offset.  Just keep it.
-        if len(response) < 2:
-            return (response,responseTime)
-        
-        # Save the first response, as by definition that's the first onset:
-        goodResp = [response[0]]
-        goodRespTime = [responseTime[0]-timeToSubtract]
-
-        # Now step through every other item in the response list to check for unique-ness.
-        for i in range(1,len(responseTime)):
-
-            if (not(response[i] == response[i-1]) or \
-                    (responseTime[i] - responseTime[i-1] > \
-                         min_interval)):
-                # ie, if something changed, or we have a long gap:
-                
-                offsetResp = [] # we might want to save an offset
-                for item in response[i-1]: # loop through last item's data
-                    if (responseTime[i] - responseTime[i-1] < \
-                            min_interval) and \
-                            not(item in response[i]):
-                        # Bit clunky.  Basically, holding down a key while pressing another creates
-                        # a unique response.  So if you only let up one of those keys, code the
-                        # offset just for that key.
-                        offsetResp.append(item+'_Off')
-                    else:
-                        # it's been long enough that everything that was on should be called off.
-                        offsetResp.append(item+'_Off')
-
-                if len(offsetResp) > 0:
-                    # If there's offset stuff to worry about, save it.
-                    goodResp.append(offsetResp)
-                    goodRespTime.append(responseTime[i-1]-timeToSubtract)
-                
-                # Save the new (onset) response.
-                goodResp.append(response[i])
-                goodRespTime.append(responseTime[i]-timeToSubtract)
-
-        # The final event should be an offset for whatever was down.
-        offsetResp = []
-        for item in response[-1]:
-            offsetResp.append(item+'_Off')
-        goodResp.append(offsetResp) #goodResp.append(response[-1]+'_Off')
-        goodRespTime.append(responseTime[-1]-timeToSubtract)
-
-        return (goodResp, goodRespTime)
-
+        return onsets_offsets(response, responseTime, timeToSubtract,
+                              min_interval)
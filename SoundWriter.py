@@ -0,0 +1,248 @@
+'''
+Saves voice recordings on a background thread, so the experiment doesn't have
+to stop and wait for them (see VoiceTriggerController's save_in_background).
+
+Clips are written as WAV files, either loose in a directory (as before), or
+all together in a single zip file - one file per session instead of thousands,
+which is much easier on network file systems.  The zip's directory is the
+index, and any zip tool (or python's zipfile) can get the clips back out.
+
+Clips are queued with put(), and the thread writes whatever has queued up in
+batches.  flush() waits for everything queued so far to be written, close()
+also stops the thread and finishes off the zip file.  For each clip we keep
+how long it waited in the queue and how long writing it took (latencies and
+stats()).
+
+To save space, clips can also be resampled (e.g., to the 16 kHz that's plenty
+for re-scoring onsets and for transcription), peak normalized, and stored as
+8 bit WAV, or losslessly compressed - as FLAC (needs the soundfile module),
+or by deflating the zip container.  That all happens on the writer's thread,
+never in the frame loop.  stats() reports the storage ratio and processing
+time per clip.
+
+'''
+
+import os
+import threading
+import time
+import wave
+import zipfile
+import Queue
+from cStringIO import StringIO
+from fractions import gcd
+
+import numpy as np
+
+
+def wav_bytes(samples, rate, sample_width=2):
+    ''' A complete WAV file for samples (an int16 array, or uint8 for a
+    sample_width of 1, with a column for each channel if there's more than
+    one), as a string '''
+    if samples.ndim > 1:
+        channels = samples.shape[1]
+    else:
+        channels = 1
+    f = StringIO()
+    wf = wave.open(f, 'wb')
+    wf.setnchannels(channels)
+    wf.setsampwidth(sample_width)
+    wf.setframerate(rate)
+    wf.writeframes(samples.astype({1: 'u1', 2: '<i2'}[sample_width])
+                   .tostring())
+    wf.close()
+    return f.getvalue()
+
+
+def resample(samples, rate, target_rate):
+    ''' Polyphase resampling (along the first axis) from rate to target_rate,
+    returning floats.  Needs scipy. '''
+    from scipy.signal import resample_poly
+    g = gcd(int(rate), int(target_rate))
+    return resample_poly(samples.astype(np.float64), int(target_rate) // g,
+                         int(rate) // g, axis=0)
+
+
+class SoundWriter(threading.Thread):
+    ''' Background writer for recorded clips.
+
+    rate, sample_width : of the clips
+    directory : where loose WAV files go (the working directory by default)
+    container : filename of a zip file to put all the clips in instead
+    batch_size : most clips to write before checking the queue again
+
+    And to save space:
+
+    target_rate : resample to this rate (needs scipy)
+    sample_format : 'int16' (as recorded), 'int8' (8 bit WAV - best with
+        normalize) or 'flac' (lossless, 16 bit, needs soundfile)
+    normalize : scale each clip so its peak is at full scale
+    compress : deflate the clips in the container (lossless)
+    '''
+    batch_size = 16
+    sample_formats = ('int16', 'int8', 'flac')
+
+    def __init__(self, rate, sample_width=2, directory=None, container=None,
+                 batch_size=None, target_rate=None, sample_format='int16',
+                 normalize=False, compress=False):
+        if sample_format not in self.sample_formats:
+            raise ValueError('sample_format must be one of %s' %
+                             ', '.join(self.sample_formats))
+        if sample_format == 'flac':
+            import soundfile  # fail now, rather than on the thread
+        if target_rate is not None and target_rate != rate:
+            import scipy.signal
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.rate = rate
+        self.sample_width = sample_width
+        self.directory = directory
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.target_rate = target_rate
+        self.sample_format = sample_format
+        self.normalize = normalize
+        self.zip = None
+        if container is not None:
+            # As recorded, the WAVs don't compress much, so don't spend the
+            # CPU on it unless asked
+            if compress:
+                compression = zipfile.ZIP_DEFLATED
+            else:
+                compression = zipfile.ZIP_STORED
+            self.zip = zipfile.ZipFile(container, 'a', compression,
+                                       allowZip64=True)
+        self.queue = Queue.Queue()
+        # (name, seconds waiting in the queue, seconds to write) per clip
+        self.latencies = []
+        # (name, bytes as recorded, bytes stored, seconds resampling and
+        # converting) per clip
+        self.sizes = []
+        self.errors = []
+        self.start()
+
+    def put(self, name, samples):
+        ''' Queue samples (an int16 array, which mustn't change afterwards) to
+        be saved as name '''
+        self.queue.put((name, samples, time.time()))
+
+    def run(self):
+        queue = self.queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            for item in batch:
+                if item is None:  # from close()
+                    queue.task_done()
+                    return
+                name, samples, queued = item
+                began = time.time()
+                try:
+                    self.write(name, samples)
+                except Exception, e:  # keep going, report it from flush
+                    self.errors.append((name, e))
+                done = time.time()
+                self.latencies.append((name, began - queued, done - began))
+                queue.task_done()
+            if self.zip is not None:
+                self.zip.fp.flush()
+
+    def encode(self, name, samples):
+        ''' The name and contents of the file to store samples in, resampled,
+        normalized and converted as asked. '''
+        rate = self.rate
+        if self.target_rate is not None and self.target_rate != rate:
+            samples = resample(samples, rate, self.target_rate)
+            rate = self.target_rate
+        else:
+            samples = samples.astype(np.float64)
+
+        gain = 1.0
+        if self.normalize:
+            peak = np.abs(samples).max()
+            if peak:
+                gain = 32767. / peak
+        if gain != 1.0:
+            samples = samples * gain
+
+        if self.sample_format == 'int8':
+            # 8 bit WAV is unsigned
+            samples = np.clip(np.round(samples / 256) + 128, 0, 255)
+            return name, wav_bytes(samples.astype(np.uint8), rate, 1)
+
+        samples = np.clip(np.round(samples), -32768, 32767).astype('<i2')
+        if self.sample_format == 'flac':
+            import soundfile
+            f = StringIO()
+            soundfile.write(f, samples, rate, format='FLAC',
+                            subtype='PCM_16')
+            return os.path.splitext(name)[0] + '.flac', f.getvalue()
+        return name, wav_bytes(samples, rate, 2)
+
+    def write(self, name, samples):
+        began = time.time()
+        if self.target_rate is None and self.sample_format == 'int16' and \
+                not self.normalize:
+            data = wav_bytes(samples, self.rate, self.sample_width)
+        else:
+            name, data = self.encode(name, samples)
+        processing = time.time() - began
+
+        stored = len(data)
+        if self.zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = self.zip.compression
+            self.zip.writestr(info, data)
+            stored = info.compress_size
+        else:
+            if self.directory is not None:
+                name = os.path.join(self.directory, name)
+            f = open(name, 'wb')
+            f.write(data)
+            f.close()
+        self.sizes.append((name, samples.size * self.sample_width, stored,
+                           processing))
+
+    def flush(self):
+        ''' Wait for everything queued so far to be written.  Raises IOError
+        if any of them couldn't be. '''
+        self.queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise IOError('could not save %s' %
+                          ', '.join('%s (%s)' % e for e in errors))
+
+    def close(self):
+        ''' Write everything that's queued, and stop '''
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+        self.flush()
+
+    def stats(self):
+        ''' Summary of self.latencies, in seconds '''
+        if not self.latencies:
+            return {'clips': 0}
+        waits = np.array([l[1] for l in self.latencies])
+        writes = np.array([l[2] for l in self.latencies])
+        stats = {'clips': len(self.latencies),
+                 'wait_mean': waits.mean(), 'wait_max': waits.max(),
+                 'write_mean': writes.mean(), 'write_max': writes.max(),
+                 'latency_max': (waits + writes).max()}
+        if self.sizes:
+            recorded = sum(s[1] for s in self.sizes)
+            stored = sum(s[2] for s in self.sizes)
+            processing = np.array([s[3] for s in self.sizes])
+            stats.update({'bytes_recorded': recorded,
+                          'bytes_stored': stored,
+                          'storage_ratio': float(stored) / recorded,
+                          'processing_mean': processing.mean(),
+                          'processing_max': processing.max()})
+        return stats
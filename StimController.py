@@ -10,9 +10,17 @@ Now that things have been made a little more general, you can do adaptive
 stuff... but its not obvious."""
 
 from datetime import datetime
+import os
+import errno
 import time
+import json
 from copy import copy
-from csv import DictWriter
+from csv import DictWriter, writer
+from array import array
+from heapq import heappush, heappop
+from collections import deque
+from timeit import default_timer as clock
+import threading
 
 import pygame
 
@@ -46,6 +54,385 @@ class RelTime:
         return retval
 
 
+class InputDispatcher:
+    '''Drains the pygame event queue once per frame, and hands the events out
+    to whichever Responses are registered for that event type.
+
+    Everything that wants input should go through the module-level
+    `dispatcher` instance rather than calling pygame.event.get or clear
+    itself - otherwise, e.g., a voice trigger controller and a keyboard
+    Response end up eating each other's events.
+
+    Events are handed out as (stamp, event), where stamp is on the same clock
+    as the t StimController gets.  For events from pygame's queue, that's just
+    the t of the frame they were drained on.  Events from an InputThread have
+    the time they were actually captured, mapped onto t.
+
+    A key press read by an InputThread (e.g., from the keyboard with
+    EvdevSource) usually reaches pygame's queue as well, a little later.  So
+    a pygame key event is dropped if the InputThread gave us the same key
+    (and type) in the last duplicate_window seconds, and that one hasn't
+    been matched to a pygame event already.
+
+    A short history of (stamp, event) is kept, so a Response that registers
+    with a ref_time earlier than the current frame still gets the events
+    since then.
+    '''
+    history_length = 256
+    duplicate_window = 0.25
+
+    # event type -> [Response, ...]
+    listeners = None
+    # Response -> [(stamp, event), ...] not yet taken
+    inboxes = None
+    history = None
+    # t of the last drain, so we only drain once per frame
+    drained_t = None
+
+    # InputThread for sub-frame timestamps, if you're using one
+    input_thread = None
+    # Best estimate of (frame t) - (clock time), see drain
+    clock_offset = None
+    # (stamp, type, key) of key events from input_thread, which pygame may
+    # give us again
+    thread_keys = None
+
+    def __init__(self, history_length=None, input_thread=None):
+        if history_length is not None:
+            self.history_length = history_length
+        self.input_thread = input_thread
+        self.listeners = {}
+        self.inboxes = {}
+        self.history = deque(maxlen=self.history_length)
+        self.thread_keys = deque()
+
+    def restart(self):
+        '''t starts over from 0 with each go, so the old history and drain
+        time don't mean anything anymore'''
+        self.history.clear()
+        self.thread_keys.clear()
+        self.drained_t = None
+        self.clock_offset = None
+
+    def drain(self, t):
+        '''Get everything from the pygame event queue - does nothing if we've
+        already drained for this t'''
+        if t == self.drained_t:
+            return
+        self.drained_t = t
+
+        if self.input_thread:
+            # t was read a little before now, so t - clock() is a bit below
+            # the real offset.  The largest value we've seen is the best
+            # estimate, and keeps it from jittering frame to frame.
+            offset = t - clock()
+            if self.clock_offset is None or offset > self.clock_offset:
+                self.clock_offset = offset
+            thread_keys = self.thread_keys
+            for stamp, event in self.input_thread.take():
+                stamp += self.clock_offset
+                self.dispatch(stamp, event)
+                if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+                    thread_keys.append((stamp, event.type, event.key))
+            while thread_keys and \
+                    thread_keys[0][0] < t - self.duplicate_window:
+                thread_keys.popleft()
+
+        for event in pygame.event.get():
+            if self.thread_keys and self.duplicate(event):
+                continue
+            self.dispatch(t, event)
+
+    def duplicate(self, event):
+        '''Whether event (from pygame) is a key event we've already had from
+        input_thread - if so, that one's been matched'''
+        if event.type not in (pygame.KEYDOWN, pygame.KEYUP):
+            return False
+        for i, (stamp, event_type, key) in enumerate(self.thread_keys):
+            if event_type == event.type and key == event.key:
+                del self.thread_keys[i]
+                return True
+        return False
+
+    def dispatch(self, stamp, event):
+        self.history.append((stamp, event))
+        for response in self.listeners.get(event.type, ()):
+            self.inboxes[response].append((stamp, event))
+
+    def register(self, response):
+        '''Start collecting events for response (only those after its
+        ref_time, if that's set)'''
+        inbox = []
+        ref_time = response.ref_time
+        for stamp, event in reversed(self.history):
+            if ref_time is not None and stamp <= ref_time:
+                break
+            if event.type == response.response_type:
+                inbox.append((stamp, event))
+        inbox.reverse()
+
+        if response not in self.inboxes:
+            self.listeners.setdefault(response.response_type, []).append(
+                response)
+        self.inboxes[response] = inbox
+
+    def unregister(self, response):
+        try:
+            del self.inboxes[response]
+            self.listeners[response.response_type].remove(response)
+        except (KeyError, ValueError):
+            pass
+
+    def take(self, response):
+        '''Return the (stamp, event)s response hasn't seen yet'''
+        try:
+            events = self.inboxes[response]
+        except KeyError:
+            # Not going through a Trial, so nobody registered us
+            self.register(response)
+            events = self.inboxes[response]
+        if events:
+            self.inboxes[response] = []
+        return events
+
+
+# The one place that input should come from
+dispatcher = InputDispatcher()
+
+
+class InputThread(threading.Thread):
+    '''Polls input sources on a background thread, timestamping each event
+    with a high resolution clock, so RTs aren't quantized to the frame rate.
+
+    A source is anything with a poll() method returning a list of pygame
+    style events (with .type, and .key for key presses).  Use it by giving it
+    to the dispatcher:
+
+        dispatcher.input_thread = InputThread([my_button_box])
+        dispatcher.input_thread.start()
+
+    Captured events go on a deque, which is safe to append to and pop from
+    across threads without a lock.  The frame loop collects them in
+    InputDispatcher.drain.
+
+    A source whose events carry their own (more accurate) times can set
+    timestamped = True, and return (clock time, event) pairs from poll().
+
+    Note that pygame's own event queue can only be read from the main thread,
+    so pygame keyboard events still go through the frame loop, and keyboard
+    RTs taken that way are still quantized to the frame rate.  Sources here
+    are for things like button boxes or serial / parallel port devices,
+    EvdevSource for reading a keyboard directly (on Linux), or
+    SyntheticInputSource for testing.
+    '''
+    poll_interval = 0.0005
+    sources = None
+    # (clock time, event) waiting to be taken by the frame loop
+    events = None
+    running = False
+
+    def __init__(self, sources, poll_interval=None):
+        threading.Thread.__init__(self)
+        # Don't keep python around just for us
+        self.daemon = True
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+        self.sources = list(sources)
+        self.events = deque()
+
+    def start(self):
+        # Before the thread starts, so a stop() straight after isn't undone
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        events = self.events
+        sources = self.sources
+        while self.running:
+            for source in sources:
+                if getattr(source, 'timestamped', False):
+                    events.extend(source.poll())
+                    continue
+                for event in source.poll():
+                    events.append((clock(), event))
+            time.sleep(self.poll_interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def take(self):
+        '''Everything captured since the last take, as (clock time, event)'''
+        taken = []
+        events = self.events
+        while events:
+            taken.append(events.popleft())
+        return taken
+
+
+# evdev key names (without KEY_) that pygame calls something else
+evdev_key_names = {
+    'enter': 'return', 'esc': 'escape', 'kpenter': 'enter',
+    'leftshift': 'left shift', 'rightshift': 'right shift',
+    'leftctrl': 'left ctrl', 'rightctrl': 'right ctrl',
+    'leftalt': 'left alt', 'rightalt': 'right alt',
+    'minus': '-', 'equal': '=', 'leftbrace': '[', 'rightbrace': ']',
+    'semicolon': ';', 'apostrophe': "'", 'grave': '`', 'backslash': '\\',
+    'comma': ',', 'dot': '.', 'slash': '/',
+    }
+
+
+class EvdevSource(object):
+    '''Reads key presses straight from a Linux input device (with the evdev
+    package), for InputThread.  Each press is timed by the kernel when it
+    arrives from the device, not when we get round to reading it, so
+    keyboard RTs aren't quantized to the frame rate:
+
+        keyboard = EvdevSource('/dev/input/by-id/usb-...-event-kbd')
+        dispatcher.input_thread = InputThread([keyboard])
+        dispatcher.input_thread.start()
+
+    Key presses come out as pygame KEYDOWN / KEYUP events with pygame key
+    codes (auto-repeats are left out).  The kernel's times are on the wall
+    clock, and are mapped onto StimController's clock by the offset between
+    the two at each poll.
+
+    The same presses will usually reach pygame's event queue too, a little
+    later - the dispatcher drops those copies (see InputDispatcher).
+    grab=True stops anything else getting them in the first place, but then
+    pygame won't see escape either.
+
+    device : path of the device, or an evdev.InputDevice
+    '''
+    timestamped = True
+    device = None
+    # evdev key code -> pygame key code
+    key_codes = None
+
+    def __init__(self, device, grab=False):
+        import evdev
+
+        if isinstance(device, basestring):
+            device = evdev.InputDevice(device)
+        self.device = device
+        if grab:
+            device.grab()
+        self.key_codes = {}
+        self.ecodes = evdev.ecodes
+
+    def key_code(self, code):
+        '''The pygame key code for evdev key code, or None'''
+        try:
+            return self.key_codes[code]
+        except KeyError:
+            pass
+        names = self.ecodes.KEY.get(code, ())
+        if isinstance(names, basestring):
+            names = [names]
+        pygame_code = None
+        for name in names:
+            name = name[len('KEY_'):].lower()
+            try:
+                pygame_code = key_code(evdev_key_names.get(name, name))
+                break
+            except KeyError:
+                pass
+        self.key_codes[code] = pygame_code
+        return pygame_code
+
+    def poll(self):
+        try:
+            read = list(self.device.read())
+        except IOError, e:
+            # EAGAIN - nothing to read
+            if e.errno != errno.EAGAIN:
+                raise
+            return []
+        clock_offset = clock() - time.time()
+
+        events = []
+        for device_event in read:
+            # value is 1 for down, 0 for up and 2 for auto-repeat
+            if device_event.type != self.ecodes.EV_KEY or \
+                    device_event.value not in (0, 1):
+                continue
+            key = self.key_code(device_event.code)
+            if key is None:
+                continue
+            if device_event.value:
+                event_type = pygame.KEYDOWN
+            else:
+                event_type = pygame.KEYUP
+            event = pygame.event.Event(event_type, key=key)
+            events.append((device_event.timestamp() + clock_offset, event))
+        return events
+
+
+# What pygame.key.name calls keys whose names aren't their K_ constant in
+# lower case (or their character)
+special_key_names = {
+    'K_PAGEUP': 'page up', 'K_PAGEDOWN': 'page down',
+    'K_CAPSLOCK': 'caps lock', 'K_SCROLLOCK': 'scroll lock',
+    'K_LSHIFT': 'left shift', 'K_RSHIFT': 'right shift',
+    'K_LCTRL': 'left ctrl', 'K_RCTRL': 'right ctrl',
+    'K_LALT': 'left alt', 'K_RALT': 'right alt',
+    'K_LMETA': 'left meta', 'K_RMETA': 'right meta',
+    'K_LSUPER': 'left super', 'K_RSUPER': 'right super',
+    'K_MODE': 'alt gr', 'K_PRINT': 'print screen', 'K_SYSREQ': 'sys req',
+    'K_KP_PERIOD': '[.]', 'K_KP_DIVIDE': '[/]', 'K_KP_MULTIPLY': '[*]',
+    'K_KP_MINUS': '[-]', 'K_KP_PLUS': '[+]', 'K_KP_ENTER': 'enter',
+    'K_KP_EQUALS': 'equals',
+    }
+for i in range(10):
+    special_key_names['K_KP%d' % i] = '[%d]' % i
+
+# key code -> name, and back, worked out from pygame's K_ constants the
+# first time they're needed
+key_names = None
+key_codes = None
+
+def constant_key_names():
+    '''key code -> name, as pygame.key.name would give it, from pygame's K_
+    constants (so without needing the display)'''
+    global key_names
+    if key_names is None:
+        import pygame.locals
+        names = {}
+        for constant in dir(pygame.locals):
+            if not constant.startswith('K_') or \
+                    constant in ('K_UNKNOWN', 'K_FIRST', 'K_LAST'):
+                continue
+            code = getattr(pygame.locals, constant)
+            if 32 < code < 127:
+                names[code] = chr(code)
+            else:
+                names[code] = special_key_names.get(constant,
+                                                    constant[2:].lower())
+        key_names = names
+    return key_names
+
+def key_name(code):
+    '''pygame.key.name - but that only knows the names once the display is
+    initialized, so before then (e.g., headless) we work them out'''
+    name = pygame.key.name(code)
+    if name == 'unknown key':
+        name = constant_key_names().get(code, name)
+    return name
+
+def key_code(name):
+    '''The inverse of key_name.  Raises KeyError for names we don't know.'''
+    global key_codes
+    pygame_key_code = getattr(pygame.key, 'key_code', None)
+    if pygame_key_code is not None:  # pygame 2
+        try:
+            return pygame_key_code(name)
+        except ValueError:
+            raise KeyError(name)
+    if key_codes is None:
+        key_codes = dict((n, c) for c, n in constant_key_names().items())
+    return key_codes[name]
+
+
 class Response(object):
     '''A generic response class that maintains information about key-presses. 
     
@@ -109,17 +496,15 @@ class Response(object):
         This could be overridden to do extended feedback, like data entry
         or updating feedback during response collection'''
         
-        responses = pygame.event.get(self.response_type)
-        # We're keeping our event queue tidy - which might be bad depending on
-        # your experiment! Subclass if necessary
-        pygame.event.clear()
+        responses = self.get_events(t)
 
-        for r in responses:
-            r_name = pygame.key.name(r.key)
+        for stamp, r in responses:
+            r_name = key_name(r.key)
             # Just grab the first thing we get if self.limit is not defined
             if self.limit is None or r_name in self.limit:
                 self.response = r_name
-                self.rt = t - self.ref_time
+                # stamp is t, unless it came from an InputThread
+                self.rt = stamp - self.ref_time
                 return True
 
         if self.timelimit is not None and \
@@ -130,6 +515,13 @@ class Response(object):
         return False
 
 
+    def get_events(self, t):
+        '''(stamp, event) for events of our response_type since we were
+        registered with the dispatcher (or since we last asked)'''
+        # A no-op if StimController already drained for this frame
+        dispatcher.drain(t)
+        return dispatcher.take(self)
+
     def response_time(self):
         '''This is trivial, but might not be with other response types'''
         try:
@@ -138,6 +530,53 @@ class Response(object):
             return None
 
 
+def same_value(a, b):
+    '''Whether setting parameter value b where a is now would change nothing'''
+    if a is b:
+        return True
+    try:
+        return bool(a == b)
+    except (ValueError, TypeError):  # e.g., numpy arrays
+        return False
+
+
+def target_stims(target):
+    '''The stimuli behind target - itself, unless it stands for several (like
+    SimpleVisionEgg.MultiStim)'''
+    return getattr(target, 'stims', None) or (target, )
+
+
+def check_parameters(target, parms):
+    '''Type check parms for target up front, as VisionEgg's set() would every
+    time.  Raises TypeError (or AttributeError, for a parameter target doesn't
+    have).  Anything that isn't a VisionEgg stimulus isn't checked.'''
+    for stim in target_stims(target):
+        specified_type = getattr(stim, 'get_specified_type', None)
+        if specified_type is None:
+            continue
+        from VisionEgg.ParameterTypes import get_type, assert_type
+        for name, value in parms.items():
+            assert_type(get_type(value), specified_type(name))
+
+
+def apply_parameters(target, parm_items):
+    '''Set only the parameters (a list of (name, value)) that differ from what
+    target already has, without type checking (see check_parameters).
+
+    The comparison is with the stimulus's current parameters, so it's still
+    right if they're set some other way.  A target without parameters (i.e.,
+    not a VisionEgg-style stimulus) just gets set(), with everything.'''
+    if not hasattr(target, 'parameters'):
+        target.set(**dict(parm_items))
+        return
+    missing = object()
+    for stim in target_stims(target):
+        params = stim.parameters
+        for name, value in parm_items:
+            if not same_value(getattr(params, name, missing), value):
+                setattr(params, name, value)
+
+
 class Event:
     """
     Events take:
@@ -201,6 +640,9 @@ class Event:
             self.stop = self.start.add(duration)
 
         parms.setdefault('on', True)
+        if target is not None:
+            # Once here, rather than on every activate
+            check_parameters(target, parms)
         self.parms = parms
         self.log = log
         self.response = response
@@ -210,17 +652,80 @@ class Event:
             msg = "on_keypress can only be set to TRUE if a response is allowed."
             raise Exception(msg)
         
-    def activate(self):
+    def activate(self, hooks=()):
+        '''Turn our target on, with our parms.  Only the parameters that
+        have changed get set (see apply_parameters), and they were checked
+        when we were made.  parms can be changed (or replaced) between
+        activations, but aren't checked again - call check_parameters if
+        that's a worry.
+
+        hooks are told about it too - each has activated(target) and
+        deactivated(target) methods (StimController passes its own, see
+        StimController.event_hooks).'''
         if self.target is not None:
-            self.target.set(**self.parms)
+            apply_parameters(self.target, self.parms.items())
+            for hook in hooks:
+                hook.activated(self.target)
         return self
 
-    def deactivate(self):
+    def deactivate(self, hooks=()):
         if self.target is not None:
-            self.target.set(on=False)
+            apply_parameters(self.target, [('on', False)])
+            for hook in hooks:
+                hook.deactivated(self.target)
         return self
 
 
+class ActiveStimuli:
+    '''Keeps a viewport's list of stimuli down to the ones Events have turned
+    on, so VisionEgg only walks through those each frame, rather than every
+    stimulus in the experiment.
+
+    stimuli is the full list, in drawing order (which we keep).  Stimuli
+    start out in the list if they're on.  After that, only Events turn them
+    on and off (as with the on parameter, the last activate or deactivate
+    wins).  A target with a stims attribute (like SimpleVisionEgg.MultiStim)
+    stands for those stimuli.
+
+    SimpleVisionEgg.set_stimuli(cull=True) makes one, and StimController
+    passes Events' activations and deactivations on to it (see
+    StimController.event_hooks) - so it only hears about the Events run on
+    that vision_egg, and goes away when set_stimuli replaces it.
+    '''
+    viewport = None
+    # stimulus -> position in the full list
+    order = None
+    active = None
+
+    def __init__(self, viewport, stimuli):
+        self.viewport = viewport
+        self.order = dict((s, i) for i, s in enumerate(stimuli))
+        self.active = set(s for s in stimuli if s.parameters.on)
+        self.update()
+
+    def update(self):
+        self.viewport.parameters.stimuli = sorted(self.active,
+                                                  key=self.order.get)
+
+    def activated(self, target):
+        changed = False
+        for s in getattr(target, 'stims', (target, )):
+            if s in self.order and s not in self.active:
+                self.active.add(s)
+                changed = True
+        if changed:
+            self.update()
+
+    def deactivated(self, target):
+        changed = False
+        for s in getattr(target, 'stims', (target, )):
+            if s in self.active:
+                self.active.remove(s)
+                changed = True
+        if changed:
+            self.update()
+
+
 class Trial:
     curr_response = None
     events = None # stimuli, etc.
@@ -228,6 +733,25 @@ class Trial:
     # The actual log of responses and stuff
     log = None
     unlogged = False
+
+    # The compiled timeline - see compile_timeline()
+    # min-heap of (onset, order, event) for events whose start is known
+    pending_events = None
+    # ref label -> [(order, event), ...] still waiting on that ref
+    waiting_events = None
+    # ref label -> resolved time, once it's known
+    ref_times = None
+    # number of events that haven't been activated yet
+    num_pending = 0
+    timeline_started = False
+    # min-heap of (stop, order, event) for active events whose stop is known
+    stopping_events = None
+    # ref label -> [(order, event), ...] active, but stop ref not known yet
+    waiting_stops = None
+    # Response -> [events, ...] that end when that Response gets a key
+    keypress_events = None
+    # events to deactivate on the next frame, regardless of stop time
+    expired_events = None
     
     @classmethod
     def from_yaml(cls, yaml_events, event_dict=None):
@@ -244,8 +768,102 @@ class Trial:
         if unlogged is not None:
             self.unlogged = unlogged
         self.events = events
-        self.active_events = []
+        self.active_events = set()
         self.log = {}    
+        self.compile_timeline()
+
+    def compile_timeline(self):
+        '''Turn our list of events into a dependency graph on RelTime refs.
+
+        Events whose ref is known go on a heap keyed by onset time, the rest
+        wait on their ref and get woken up when it resolves (e.g., when a
+        Response with that label records).  So each frame we only look at the
+        top of the heap, rather than re-checking the events list.
+
+        Raises ValueError if the refs form a cycle (e.g., an event starting
+        after its own response).  A ref that no event provides may still be
+        put in our log before the trial runs, so that's only checked when it
+        starts (see start_timeline).'''
+        providers = self.providers()
+
+        # Each event waits on exactly one provider, so following start refs
+        # from any event either ends at a root or goes around a cycle
+        checked = set()
+        for event in self.events:
+            path = []
+            curr = event
+            while curr is not None and curr not in checked:
+                if curr in path:
+                    cycle = path[path.index(curr):] + [curr]
+                    raise ValueError('Cycle in event start times: ' + 
+                        ' -> '.join(e.start.ref for e in cycle))
+                path.append(curr)
+                curr = providers.get(curr.start.ref)
+            checked.update(path)
+
+        self.pending_events = []
+        self.waiting_events = {}
+        self.ref_times = {}
+        for order, event in enumerate(self.events):
+            self.waiting_events.setdefault(event.start.ref, []).append(
+                (order, event))
+        self.num_pending = len(self.events)
+        self.timeline_started = False
+
+        self.stopping_events = []
+        self.waiting_stops = {}
+        self.keypress_events = {}
+        self.expired_events = []
+
+    def providers(self):
+        '''ref label -> the event that makes it available, or None if it's
+        available before any events (trial_start, or something already
+        logged)'''
+        providers = {'trial_start': None}
+        for label in self.log:
+            providers[label] = None
+        for event in self.events:
+            if event.log:
+                for log_k in event.log:
+                    providers.setdefault(log_k, event)
+            if event.response:
+                providers.setdefault(event.response.label, event)
+        return providers
+
+    def resolve_ref(self, label, ref_time):
+        '''Record that `label` happened at `ref_time`, and schedule any events
+        that were waiting on it'''
+        if label in self.ref_times:
+            return
+        self.ref_times[label] = ref_time
+        for order, event in self.waiting_events.pop(label, ()):
+            heappush(self.pending_events,
+                     (ref_time + event.start.offset, order, event))
+        for order, event in self.waiting_stops.pop(label, ()):
+            heappush(self.stopping_events,
+                     (ref_time + event.stop.offset, order, event))
+
+    def start_timeline(self):
+        '''Resolve anything that got logged before our first frame - usually
+        just trial_start.  Raises ValueError if an event refers to something
+        nothing provides.'''
+        self.timeline_started = True
+        providers = self.providers()
+        for event in self.events:
+            for event_time in (event.start, event.stop):
+                if event_time.ref not in providers:
+                    raise ValueError('Event refers to "%s", but no event in '
+                                     'this Trial provides it' % event_time.ref)
+
+        # Stop refs wait on these too, so resolve them all
+        for label, ref_time in self.log.items():
+            try:
+                ref_time = ref_time.response_time()
+            except AttributeError:
+                pass
+
+            if ref_time is not None:
+                self.resolve_ref(label, ref_time)
 
     def event_ready(self, event_time, t):
         try:
@@ -266,55 +884,346 @@ class Trial:
         else:
             return t - ref_time >= event_time.offset
 
-    def activate_events(self, t):
-        # We can potentially activate several events if they are all ready
-        while self.events:
-            if self.event_ready(self.events[0].start,  t):
-                event = self.events.pop(0)
-                event.activate()
-                self.active_events.append(event)
-
-                if event.log:
-                    for log_k, log_v in event.log.items():
-                        self.log[log_k] = log_v
-                if event.response:
-                    # Make sure we only get inputs after the start of the
-                    # response period
-                    pygame.event.clear()
-
-                    event.response.ref_time = t
-                    self.log[event.response.label] = event.response
-                    self.curr_response = event.response
+    def activate_events(self, t, hooks=()):
+        '''hooks are passed on to Event.activate'''
+        if not self.timeline_started:
+            self.start_timeline()
+
+        # We can potentially activate several events if they are all ready,
+        # and activating one can make others ready in the same frame
+        pending = self.pending_events
+        while pending and pending[0][0] <= t:
+            order, event = heappop(pending)[1:]
+            self.num_pending -= 1
+            event.activate(hooks)
+            self.active_events.add(event)
+            self.schedule_stop(order, event)
+
+            if event.log:
+                for log_k, log_v in event.log.items():
+                    self.log[log_k] = log_v
+                    # Events may be waiting to start or stop on it
+                    self.resolve_ref(log_k, log_v)
+            if event.response:
+                if self.curr_response:
+                    dispatcher.unregister(self.curr_response)
+                # The dispatcher makes sure we only get inputs after the start
+                # of the response period
+                event.response.ref_time = t
+                dispatcher.register(event.response)
+                self.log[event.response.label] = event.response
+                self.curr_response = event.response
+
+    def schedule_stop(self, order, event):
+        '''Index a newly active event by its stop time, or by its stop ref if
+        that isn't known yet'''
+        try:
+            stop_time = self.ref_times[event.stop.ref]
+        except KeyError:
+            self.waiting_stops.setdefault(event.stop.ref, []).append(
+                (order, event))
+        else:
+            heappush(self.stopping_events,
+                     (stop_time + event.stop.offset, order, event))
 
+        if event.on_keypress:
+            if event.response.response:
+                self.expired_events.append(event)
             else:
-                break
+                self.keypress_events.setdefault(event.response, []).append(
+                    event)
 
     def log_response(self, t):
-        if self.curr_response and \
-                self.curr_response.record_response(t):
+        response = self.curr_response
+        if response and response.record_response(t):
             self.curr_response = None
+            dispatcher.unregister(response)
+            self.resolve_ref(response.label, response.response_time())
+            # on_keypress events only end for an actual key, not a timeout
+            if response.response:
+                self.expired_events.extend(
+                    self.keypress_events.pop(response, ()))
+
+    def deactivate_event(self, event, hooks=()):
+        # An event can be expired by keypress and by time, but only gets
+        # deactivated once
+        if event in self.active_events:
+            event.deactivate(hooks)
+            self.active_events.remove(event)
+
+    def deactivate_events(self, t, hooks=()):
+        '''hooks are passed on to Event.deactivate'''
+        stopping = self.stopping_events
+        while stopping and stopping[0][0] <= t:
+            self.deactivate_event(heappop(stopping)[2], hooks)
+
+        expired = self.expired_events
+        while expired:
+            self.deactivate_event(expired.pop(), hooks)
+
+    def done(self):
+        return not (self.num_pending or self.active_events)
+
+    def finish(self):
+        '''Called by StimController once we're done'''
+        if self.curr_response:
+            # Nobody's going to take the events anymore
+            dispatcher.unregister(self.curr_response)
+
+
+def conv_log(items):
+    '''This converts our responses to a flat dict'''
+    retval = {} 
+    for label, obj in items:
+        try:
+            # For greater generality, this could be a method of
+            # Response...
+            for param, param_value in obj.__dict__.items():
+                if param not in obj.unlogged:
+                    comp_key = '.'.join((label, param))
+                    retval[comp_key] = param_value
+        except AttributeError:
+            # It's just a number or string (we hope)
+            retval[label] = obj 
+
+    return retval
+
+
+class LogStream:
+    '''An append-only log that gets one line per Trial as each Trial finishes,
+    so a crash doesn't cost you the whole session.
+
+    Lines are JSON objects (i.e., the file is JSONL), so columns can show up
+    whenever they like.  The union of all columns is kept in a small side file
+    (filename + '.header'), so merge_log() can produce the same CSV as
+    StimController.writelog without holding the session in memory.
+
+    Each line is handed to the OS as it's written, so it's there even if
+    python dies, but we only fsync (which can take a while) every
+    `sync_every` trials, or when sync() is called.  StimController writes
+    each trial as it finishes, before the next one starts, and syncs while
+    paused and when run_trials returns.
+    '''
+    f = None
+    header = None
+    header_fname = None
+    sync_every = 10
+    # number of trials written since the last sync
+    unsynced = 0
+
+    def __init__(self, f, sync_every=None):
+        '''f can be a filename or a file opened for appending.  We only keep
+        a side header if we know the filename.'''
+        if sync_every is not None:
+            self.sync_every = sync_every
+        try:
+            f.write
+        except AttributeError:
+            self.header_fname = f + '.header'
+            f = open(f, 'a')
+        self.f = f
+        self.header = set()
 
-    def deactivate_events(self, t):
-        # We make a copy so we can modify the real list
-        for event in copy(self.active_events):
-            if self.event_ready(event.stop, t):
-                event.deactivate()
-                self.active_events.remove(event)
-            # my addition to allow for keypress-responsive events follows
-            # 'try' is more pythonic (and faster) than checking for attribute
-            # existence -DJC
+        if self.header_fname:
             try:
-                if event.on_keypress and event.response.response:
-                    event.deactivate()
-                    # not sure if the event needs to be removed
-                    # from the list of active events.
-                    self.active_events.remove(event)
-            except ValueError:
+                self.header.update(read_header(self.header_fname))
+            except IOError:
                 pass
 
+    def write_trial(self, trial):
+        log_line = conv_log(trial.log.items())
+        self.f.write(json.dumps(log_line, default=str))
+        self.f.write('\n')
+        self.f.flush()
+
+        if not self.header.issuperset(log_line):
+            self.header.update(log_line)
+            self.write_header()
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def write_header(self):
+        if not self.header_fname:
+            return
+        # Write then rename, so we never leave a partial header behind
+        tmp_fname = self.header_fname + '.tmp'
+        header_f = open(tmp_fname, 'w')
+        header_f.write(json.dumps(sorted(self.header)))
+        header_f.close()
+        os.rename(tmp_fname, self.header_fname)
+
+    def sync(self):
+        if not self.unsynced:
+            return
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+
+def read_header(header_fname):
+    header_f = open(header_fname)
+    try:
+        return [str(h) for h in json.load(header_f)]
+    finally:
+        header_f.close()
+
+
+def merge_log(stream_fname, f):
+    '''Convert a LogStream file into a CSV like that from
+    StimController.writelog.  f can be a filename or a file opened for
+    writing.
+
+    Rows are streamed through one at a time.  If there's no side header we
+    make an extra pass over the file to find the columns.'''
+    try:
+        header = read_header(stream_fname + '.header')
+    except IOError:
+        header = set()
+        for line in open(stream_fname):
+            header.update(json.loads(line))
+        header = sorted(str(h) for h in header)
+
+    try:
+        dw = DictWriter(f, header)
+    except TypeError:
+        dw = DictWriter(open(f, 'w'), header)
+
+    dw.writer.writerow(header)
+    for line in open(stream_fname):
+        log_line = {}
+        for k, v in json.loads(line).items():
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            log_line[str(k)] = v
+        dw.writerow(log_line)
+
+
+def load_log_npz(f):
+    '''Load a log written by StimController.writelog_npz, returning a dict of
+    column name -> numpy array (one entry per trial).  Categorical columns are
+    expanded back into string arrays, with '' for missing values.'''
+    import numpy as np
+
+    npz = np.load(f)
+    columns = {}
+    for name in npz.files:
+        if name.endswith(':categories'):
+            continue
+        data = npz[name]
+        try:
+            categories = npz[name + ':categories']
+        except KeyError:
+            columns[name] = data
+        else:
+            # code -1 (missing) picks up the '' we put on the end
+            columns[name] = np.append(categories, '')[data]
+
+    return columns
 
-    def done(self):
-        return not (self.events or self.active_events)
+
+class FrameTimer:
+    '''Per-frame timing for StimController, so you can see which Trial a slow
+    frame happened in.
+
+    For each frame we keep the time (t), the interval since the last frame
+    (dt), the time spent in Trial.deactivate_events, log_response and
+    activate_events, and the index of the current trial in
+    StimController.trials.  Those are timed with timeit's default_timer, as
+    time.time is too coarse for them on some platforms (Windows).
+    Everything goes in preallocated arrays used as a ring buffer, so only
+    the last `size` frames are kept.
+
+    dt is 0 for the first frame of each run_trials, as VisionEgg starts t
+    over from 0 with each go().
+
+    If `budget` (in seconds) is set, frames with dt over budget are flagged as
+    slow.  Something like 1.5 / 60 is reasonable for a 60 Hz display.
+    '''
+    # 10 minutes at 60 Hz
+    size = 36000
+    budget = None
+
+    # total number of frames seen, and how many were slow
+    count = 0
+    slow_count = 0
+    prev_t = None
+
+    # Accumulated by StimController during the current frame
+    curr_deactivate = 0.0
+    curr_log_response = 0.0
+    curr_activate = 0.0
+
+    columns = ('frame', 't', 'dt', 'deactivate', 'log_response', 'activate',
+               'trial', 'slow')
+
+    def __init__(self, size=None, budget=None):
+        if size is not None:
+            self.size = size
+        if budget is not None:
+            self.budget = budget
+
+        self.times = array('d', [0.0]) * self.size
+        self.intervals = array('d', [0.0]) * self.size
+        self.deactivate_times = array('d', [0.0]) * self.size
+        self.log_response_times = array('d', [0.0]) * self.size
+        self.activate_times = array('d', [0.0]) * self.size
+        self.trial_indices = array('l', [0]) * self.size
+        self.slow = array('b', [0]) * self.size
+
+    def end_frame(self, t, trial_index):
+        i = self.count % self.size
+        if self.prev_t is None or t < self.prev_t:
+            # The first frame, or the first since VisionEgg started t over
+            # (it does with each go), so there's no interval
+            dt = 0.0
+        else:
+            dt = t - self.prev_t
+        self.prev_t = t
+
+        self.times[i] = t
+        self.intervals[i] = dt
+        self.deactivate_times[i] = self.curr_deactivate
+        self.log_response_times[i] = self.curr_log_response
+        self.activate_times[i] = self.curr_activate
+        self.trial_indices[i] = trial_index
+        if self.budget is not None and dt > self.budget:
+            self.slow[i] = 1
+            self.slow_count += 1
+        else:
+            self.slow[i] = 0
+
+        self.curr_deactivate = self.curr_log_response = self.curr_activate = 0.0
+        self.count += 1
+
+    def frames(self):
+        '''Generator giving the frames we still have, oldest first, as tuples
+        in the order of FrameTimer.columns'''
+        first = max(0, self.count - self.size)
+        for frame in xrange(first, self.count):
+            i = frame % self.size
+            yield (frame, self.times[i], self.intervals[i],
+                   self.deactivate_times[i], self.log_response_times[i],
+                   self.activate_times[i], self.trial_indices[i],
+                   self.slow[i])
+
+    def slow_frames(self):
+        return [f for f in self.frames() if f[-1]]
+
+    def write(self, f):
+        '''Write frames to f as a CSV - f can be a filename or a file opened
+        for writing'''
+        try:
+            w = writer(f)
+        except TypeError:
+            w = writer(open(f, 'w'))
+
+        w.writerow(self.columns)
+        w.writerows(self.frames())
 
 
 class StimController:
@@ -324,21 +1233,49 @@ class StimController:
 
     # SimpleVisionEgg instance
     vision_egg = None
+    # LogStream instance, if we're writing trials as we go
+    log_stream = None
+    # number of trials finished so far
+    trials_finished = 0
+    # passed to every Event activation and deactivation - see event_hooks
+    hooks = ()
+    # FrameTimer instance, if we're keeping track of frame timing
+    frame_timer = None
+    # TextureCache instance, if pictures are loaded as they're needed
+    texture_cache = None
 
     # Attribs for keeping track of experiment
     go_duration = ('forever', )
     state = None
     trials_to_run = 0 # == run all of them
+    # index into trials of the current trial
+    trial_index = 0
 
 
-    def __init__(self, trials, vision_egg, pause_event=None):
+    def __init__(self, trials, vision_egg, pause_event=None, log_stream=None,
+                 frame_timer=None, texture_cache=None):
         """vision_egg is an instance of SimpleVisionEgg
         pause_event is an Event which will be shown at the beginning of
-        every stim_controller.run_trials loop."""
+        every stim_controller.run_trials loop.
+        log_stream is a LogStream, or a filename to open one on.  Each trial
+        is appended to it as it finishes, and it's closed after the last
+        trial.
+        frame_timer is a FrameTimer, which will record timing for every frame.
+        Save it with frame_timer.write() after the run.
+        texture_cache is a TextureCache, which will load the pictures for the
+        next few trials as we go."""
             
         self.trials = trials
         self.vision_egg = vision_egg
         self.pause_event = pause_event
+        if log_stream is not None:
+            if not isinstance(log_stream, LogStream):
+                log_stream = LogStream(log_stream)
+            self.log_stream = log_stream
+        self.frame_timer = frame_timer
+        if texture_cache is not None:
+            texture_cache.watch(self)
+            self.texture_cache = texture_cache
 
         self.state = self.state_generator()
         self.state.next()
@@ -353,7 +1290,32 @@ class StimController:
             self.trials_to_run = len(self.trials)
         else:
             self.trials_to_run = num
+        dispatcher.restart()
+        # set_stimuli may have been called since last time
+        self.hooks = self.event_hooks()
         self.vision_egg.go()
+        # go() returns when we pause, so nothing timing critical is happening
+        self.sync_log()
+        if self.log_stream and self.trials_finished == len(self.trials):
+            self.log_stream.close()
+            self.log_stream = None
+
+    def event_hooks(self):
+        '''Everything that needs to hear about the Events we activate and
+        deactivate: our vision_egg's ActiveStimuli, if it's culling, and our
+        texture_cache'''
+        hooks = []
+        active_stimuli = getattr(self.vision_egg, 'active_stimuli', None)
+        if active_stimuli is not None:
+            hooks.append(active_stimuli)
+        if self.texture_cache is not None:
+            hooks.append(self.texture_cache)
+        return hooks
+
+    def sync_log(self):
+        '''Make sure the trials written to log_stream are on disk'''
+        if self.log_stream:
+            self.log_stream.sync()
 
     def compute_go_duration(self, units='seconds'):
         """This should run through the trials, find the latest stimulus and add
@@ -372,33 +1334,67 @@ class StimController:
     def update(self, t):
         """Wrapper to adapt the state generator into a regular function"""
         self.state.send(t)
+        if self.frame_timer:
+            self.frame_timer.end_frame(t, self.trial_index)
+        if self.texture_cache:
+            self.texture_cache.idle()
 
     def pause_update(self):
         """Simple function to set the screen displaying some text"""
         if self.pause_event:
-            self.pause_event.activate()
+            self.pause_event.activate(self.hooks)
+        # Nothing timing critical is happening, so sync the log
+        self.sync_log()
+        if self.texture_cache:
+            self.texture_cache.idle()
 
     def state_generator(self):
         # Initial yeild to get us into accepting "send" calls
         t = yield
 
+        frame_timer = self.frame_timer
+        timer = clock
+
         trial_num = 0
-        for trial in self.trials:
+        for self.trial_index, trial in enumerate(self.trials):
             trial_num += 1
             if self.pause_event:
-                self.pause_event.deactivate()
+                self.pause_event.deactivate(self.hooks)
             trial.log['trial_start'] = t
 
             # Note that the order of activates, deactivates and yields is
             # critical for instantaneous stimuli to appear properly (or at all)
             while True:
-                trial.deactivate_events(t)
-                trial.log_response(t)
-                trial.activate_events(t)
+                # All input for this frame comes through here
+                dispatcher.drain(t)
+                hooks = self.hooks
+                if frame_timer:
+                    t0 = timer()
+                    trial.deactivate_events(t, hooks)
+                    t1 = timer()
+                    trial.log_response(t)
+                    t2 = timer()
+                    trial.activate_events(t, hooks)
+                    t3 = timer()
+                    # += as more than one trial can run in a frame
+                    frame_timer.curr_deactivate += t1 - t0
+                    frame_timer.curr_log_response += t2 - t1
+                    frame_timer.curr_activate += t3 - t2
+                else:
+                    trial.deactivate_events(t, hooks)
+                    trial.log_response(t)
+                    trial.activate_events(t, hooks)
                 if trial.done():
                     break
                 t = yield
 
+            trial.finish()
+            self.trials_finished += 1
+            if self.log_stream and not trial.unlogged:
+                # Between trials, so it's only the next trial's first frame
+                # that waits for this (and the fsync every sync_every)
+                self.log_stream.write_trial(trial)
+
             if trial_num == self.trials_to_run:
                 trial_num = 0
                 self.vision_egg.pause()
@@ -416,23 +1412,6 @@ class StimController:
         This function takes everything and puts it in one big table - padded
         with Nones for missing items.  You may want to use something else if
         your log would be relatively "sparse"'''
-        def conv_log(items):
-            '''This converts our responses to a flat dict'''
-            retval = {} 
-            for label, obj in items:
-                try:
-                    # For greater generality, this could be a method of
-                    # Response...
-                    for param, param_value in obj.__dict__.items():
-                        if param not in obj.unlogged:
-                            comp_key = '.'.join((label, param))
-                            retval[comp_key] = param_value
-                except AttributeError:
-                    # It's just a number or string (we hope)
-                    retval[label] = obj 
-
-            return retval
-
         log = []
         header = set()
         for t in self.trials:
@@ -457,6 +1436,40 @@ class StimController:
         dw.writer.writerow(header)
         dw.writerows(log)
 
+    def writelog_npz(self, f):
+        '''Write log to f as typed columns in a numpy .npz file - f can be a
+        filename or a file opened for writing.  Load it with load_log_npz.
+
+        Column types are worked out once, here: numbers (RTs, timestamps) are
+        float arrays with NaN for missing values, strings that repeat a lot
+        (keys, conditions) are stored as integer codes plus a
+        "<column>:categories" array, and anything else is a string array.'''
+        # numpy is only needed for this, so we don't make everyone install it
+        import numpy as np
+
+        def conv_column(name, values):
+            present = [v for v in values if v is not None]
+            if all(isinstance(v, (int, long, float)) for v in present):
+                return {name: np.array([np.nan if v is None else v
+                                        for v in values], dtype=float)}
+
+            categories = sorted(set(str(v) for v in present))
+            if 2 * len(categories) > len(values):
+                return {name: np.array(['' if v is None else str(v) 
+                                        for v in values])}
+
+            index = dict((c, i) for i, c in enumerate(categories))
+            codes = np.array([-1 if v is None else index[str(v)]
+                              for v in values], dtype=np.int32)
+            return {name: codes, name + ':categories': np.array(categories)}
+
+        header, log = self.loglines()
+        columns = {}
+        for name in header:
+            columns.update(conv_column(name, [l.get(name) for l in log]))
+
+        np.savez(f, **columns)
+
     def getOutputFilename(self, subjectName, experimentname):
         # function to avoid overwriting data
         # writes a .datalog file that holds subject and testing date for each block
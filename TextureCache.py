@@ -0,0 +1,350 @@
+'''
+Loads pictures for stimuli when they're needed, rather than all up front, and
+keeps only as many loaded as fit in a memory budget.
+
+Give each picture stimulus a texture_file attribute (the image to show)
+instead of loading its Texture yourself, and pass the cache to the
+StimController:
+
+    cache = TextureCache(memory_budget=512 * 2**20, lookahead=3)
+
+    class PicStim(TextureStimulus):
+        def __init__(self, picname):
+            self.texture_file = STIM_DIRECTORY + picname
+            TextureStimulus.__init__(self, texture=cache.placeholder(), ...)
+
+    stim_control = StimController(trials, vision_egg, texture_cache=cache)
+
+The first trial's pictures are loaded before it starts, and the next
+lookahead trials' are decoded on a background thread as the experiment runs.
+In frames where no picture goes up, a decoded picture is handed to its (not
+yet shown) stimulus and uploaded to the graphics card - one per frame - so
+showing it later costs nothing.  If a picture isn't ready in time, it's
+loaded when its Event starts - in the frame, so that frame may be late.
+Those are counted in misses, and kept in miss_times with how long loading
+took.  Nothing is printed while the experiment runs; close() stops the
+loading thread and logs a summary (see report).
+
+Pictures that were used least recently are dropped once memory_budget (in
+bytes, estimated from each texture's size) is used up - apart from those
+showing now or in the next lookahead trials.  Their stimuli go back to the
+placeholder, so the memory really is freed.
+
+'''
+
+import threading
+import time
+import logging
+import Queue
+from collections import OrderedDict, deque
+
+from cognac.StimController import target_stims
+
+
+def load_texture(filename):
+    ''' Decode filename into a VisionEgg Texture (no OpenGL needed, so this
+    can run on any thread) '''
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    from VisionEgg.Textures import Texture
+    image = Image.open(filename)
+    image.load()  # decode now, not when it's uploaded
+    return Texture(image)
+
+
+def texture_bytes(texture):
+    ''' Rough memory use of a texture, as RGBA '''
+    size = getattr(texture, 'size', None)
+    if size is None:
+        return 0
+    return 4 * size[0] * size[1]
+
+
+class TextureCache:
+    ''' LRU cache of textures, by file name, with background prefetching of
+    upcoming trials' pictures.  See the module docstring.
+
+    memory_budget : bytes of textures to keep loaded
+    lookahead : number of trials to load ahead
+    loader : function from file name to texture (default load_texture)
+    sizeof : function from texture to bytes (default texture_bytes)
+    placeholder : texture for stimuli whose picture isn't loaded (a tiny
+        blank one by default)
+    '''
+    memory_budget = 256 * 2**20
+    lookahead = 3
+    loader = None
+    sizeof = None
+
+    stim_controller = None
+    # file name -> texture, least recently used first
+    textures = None
+    bytes_used = 0
+    # Loaded synchronously because they weren't ready
+    misses = 0
+    hits = 0
+    # (file name, seconds it took) for each miss
+    miss_times = None
+    # (file name, exception) for pictures the loading thread couldn't load
+    load_errors = None
+
+    def __init__(self, memory_budget=None, lookahead=None, loader=None,
+                 sizeof=None, placeholder=None):
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        if lookahead is not None:
+            self.lookahead = lookahead
+        self.loader = loader or load_texture
+        self.sizeof = sizeof or texture_bytes
+
+        self.textures = OrderedDict()
+        self.miss_times = []
+        self.load_errors = []
+        self.lock = threading.Lock()
+        # file name -> set of stimuli showing it
+        self.users = {}
+        # trial -> file names its events show (worked out when needed)
+        self.trial_files = {}
+        # file names that shouldn't be dropped (showing or coming up)
+        self.pinned = set()
+        # file names queued for, or being loaded by, the background thread
+        self.queued = set()
+        # decoded by the background thread, not given to a stimulus yet
+        self.decoded = deque()
+        self.seen_index = None
+        # did a picture go up this frame?
+        self.busy = False
+        self._placeholder = placeholder
+
+        self.requests = Queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def placeholder(self):
+        ''' A tiny texture for stimuli whose picture isn't loaded '''
+        if self._placeholder is None:
+            from VisionEgg.Textures import Texture
+            self._placeholder = Texture(size=(4, 4))
+        return self._placeholder
+
+    def watch(self, stim_controller):
+        ''' Start following stim_controller's trials.  Loads the first
+        trial's pictures before returning, and starts on the next ones.
+        stim_controller tells us about its Events (see
+        StimController.event_hooks). '''
+        self.stim_controller = stim_controller
+        self.seen_index = stim_controller.trial_index
+        self.update_pinned()
+        if stim_controller.trials:
+            for fname in self.files(stim_controller.trials[0]):
+                if fname not in self.textures:
+                    self.detach(self.add(fname, self.loader(fname)))
+        self.prefetch(self.pinned)
+
+    def unwatch(self):
+        self.stim_controller = None
+
+    def files(self, trial):
+        ''' File names of the pictures in trial '''
+        try:
+            return self.trial_files[trial]
+        except KeyError:
+            files = []
+            for event in trial.events:
+                if event.target is None:
+                    continue
+                for stim in target_stims(event.target):
+                    fname = getattr(stim, 'texture_file', None)
+                    if fname is not None and fname not in files:
+                        files.append(fname)
+            self.trial_files[trial] = files
+            return files
+
+    def upcoming(self):
+        ''' (stimulus, file name) for the current and next lookahead trials '''
+        sc = self.stim_controller
+        if sc is None:
+            return []
+        stims = []
+        start = sc.trial_index
+        for trial in sc.trials[start:start + 1 + self.lookahead]:
+            for event in trial.events:
+                if event.target is None:
+                    continue
+                for stim in target_stims(event.target):
+                    fname = getattr(stim, 'texture_file', None)
+                    if fname is not None:
+                        stims.append((stim, fname))
+        return stims
+
+    def update_pinned(self):
+        sc = self.stim_controller
+        pinned = set()
+        start = sc.trial_index
+        for trial in sc.trials[start:start + 1 + self.lookahead]:
+            pinned.update(self.files(trial))
+        for fname, stims in self.users.items():
+            if [s for s in stims if s.parameters.on]:
+                pinned.add(fname)
+        self.pinned = pinned
+
+    def get(self, fname):
+        ''' The texture for fname, loading it now if need be (on the main
+        thread, as that can mean dropping others) '''
+        self.lock.acquire()
+        try:
+            texture = self.textures.pop(fname, None)
+            if texture is not None:
+                self.textures[fname] = texture  # most recently used
+                self.hits += 1
+                return texture
+        finally:
+            self.lock.release()
+
+        began = time.time()
+        texture = self.loader(fname)
+        self.misses += 1
+        self.miss_times.append((fname, time.time() - began))
+        self.detach(self.add(fname, texture))
+        return texture
+
+    def add(self, fname, texture):
+        ''' Put texture in the cache, returning the names of any that were
+        dropped to make room - pass those to detach (on the main thread) '''
+        self.lock.acquire()
+        try:
+            if fname not in self.textures:
+                self.textures[fname] = texture
+                self.bytes_used += self.sizeof(texture)
+            dropped = self.shrink()
+        finally:
+            self.lock.release()
+        return dropped
+
+    def shrink(self):
+        ''' Drop least recently used textures until we're within budget,
+        returning their names.  Call with the lock held. '''
+        dropped = []
+        if self.bytes_used <= self.memory_budget:
+            return dropped
+        for fname in list(self.textures):
+            if fname in self.pinned:
+                continue
+            texture = self.textures.pop(fname)
+            self.bytes_used -= self.sizeof(texture)
+            dropped.append(fname)
+            if self.bytes_used <= self.memory_budget:
+                break
+        return dropped
+
+    def detach(self, fnames):
+        ''' Put the placeholder back on stimuli that were showing fnames (and
+        aren't on) - on the main thread, as this can mean OpenGL calls '''
+        for fname in fnames:
+            for stim in self.users.pop(fname, ()):
+                if not stim.parameters.on:
+                    stim.parameters.texture = self.placeholder()
+
+    def attach(self, stim, fname, texture):
+        ''' Give stim texture, returning whether it didn't have it already '''
+        self.users.setdefault(fname, set()).add(stim)
+        if stim.parameters.texture is texture:
+            return False
+        stim.parameters.texture = texture
+        return True
+
+    def prefetch(self, fnames):
+        ''' Load fnames on the background thread '''
+        for fname in fnames:
+            self.lock.acquire()
+            try:
+                wanted = fname not in self.textures and \
+                    fname not in self.queued
+                if wanted:
+                    self.queued.add(fname)
+            finally:
+                self.lock.release()
+            if wanted:
+                self.requests.put(fname)
+
+    def run(self):
+        while True:
+            fname = self.requests.get()
+            if fname is None:  # from close
+                break
+            try:
+                texture = self.loader(fname)
+            except Exception, e:  # it'll get loaded (and fail) when needed
+                self.load_errors.append((fname, e))
+                texture = None
+            if texture is not None:
+                self.decoded.append((fname, self.add(fname, texture)))
+            self.lock.acquire()
+            self.queued.discard(fname)
+            self.lock.release()
+
+    def activated(self, target):
+        ''' Event hook - make sure target has its picture '''
+        for stim in target_stims(target):
+            fname = getattr(stim, 'texture_file', None)
+            if fname is not None:
+                self.busy = True
+                self.attach(stim, fname, self.get(fname))
+
+    def deactivated(self, target):
+        pass
+
+    def idle(self):
+        ''' Called once a frame by StimController.  Starts loading ahead when
+        a new trial starts, and (in frames where no picture went up) gives
+        one decoded picture to its stimulus, and uploads it. '''
+        sc = self.stim_controller
+        if sc is not None and sc.trial_index != self.seen_index:
+            self.seen_index = sc.trial_index
+            self.update_pinned()
+            self.prefetch(self.pinned)
+
+        if self.busy:
+            self.busy = False
+            return
+        while self.decoded:
+            fname, dropped = self.decoded.popleft()
+            self.detach(dropped)
+            texture = self.textures.get(fname)
+            if texture is None:  # already dropped again
+                continue
+            uploaded = False
+            for stim, stim_fname in self.upcoming():
+                if stim_fname != fname or stim.parameters.on or \
+                        not self.attach(stim, fname, texture):
+                    continue
+                # VisionEgg would do this the first time it's drawn
+                reload_texture = getattr(stim, '_reload_texture', None)
+                if reload_texture is not None:
+                    reload_texture()
+                    uploaded = True
+            if uploaded:
+                return
+
+    def report(self):
+        ''' Log how the cache did - the misses (pictures that were loaded in
+        the frame they were needed) and pictures that couldn't be loaded '''
+        logger = logging.getLogger('VisionEgg')
+        logger.info('TextureCache: %d hits, %d misses' %
+                    (self.hits, self.misses))
+        for fname, took in self.miss_times:
+            logger.warning('TextureCache: %s was not loaded in time, loading '
+                           'it took %.1f ms' % (fname, 1000 * took))
+        for fname, e in self.load_errors:
+            logger.warning('TextureCache: could not load %s: %s' % (fname, e))
+
+    def close(self):
+        ''' Stop following the StimController, stop the loading thread, and
+        report '''
+        self.unwatch()
+        self.requests.put(None)
+        self.thread.join()
+        self.report()
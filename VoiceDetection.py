@@ -0,0 +1,256 @@
+'''
+Voice activity detection for VoiceTrigger, kept separate from the audio and
+VisionEgg code so it can be tested and benchmarked on its own (see
+benchmarks/bench_voicetrigger.py).
+
+A detector takes a chunk of int16 samples and returns a detection signal along
+with onset and offset thresholds for it.  TriggerDebouncer then turns those
+into one onset and offset per utterance.
+
+PeakDetector is the original VoiceTrigger behavior - the raw samples against a
+fixed threshold.  EnergyDetector band-pass filters to the speech range, takes
+the short-term energy, and triggers relative to a noise floor it keeps track
+of, so it copes with hum and background noise without hand tuning.
+
+calibrate_threshold picks a PeakDetector threshold from recordings of noise
+(and speech), so that doesn't need hand tuning either.
+
+'''
+
+import numpy as np
+
+
+class PeakDetector(object):
+    ''' Raw samples against a fixed threshold. offset_threshold defaults to
+    half of threshold.
+    '''
+
+    def __init__(self, threshold=1000, offset_threshold=None):
+        self.threshold = threshold
+        if offset_threshold is None:
+            offset_threshold = threshold / 2
+        self.offset_threshold = offset_threshold
+
+    def process(self, chunk, speaking=False):
+        return chunk, self.threshold, self.offset_threshold
+
+
+class EnergyDetector(object):
+    ''' Band-limited energy against an adaptive noise floor.
+
+    Each chunk is band-pass filtered (a Butterworth filter over band, in Hz)
+    and squared, then smoothed with a one-pole filter of time constant window
+    (in seconds), giving an RMS envelope.  Both filters carry their state from
+    chunk to chunk, so the result is the same however the audio is chunked.
+
+    The mean and standard deviation (sigma) of the envelope are tracked with
+    exponential averaging over noise_time seconds, but only from chunks
+    without speech.  Onset is at k sigma over the mean, offset at k_offset
+    sigma (k / 2 by default).  sigma is never taken to be less than
+    min_sigma, so digital silence doesn't make it trigger on anything.
+
+    Needs scipy (for the filters).
+    '''
+
+    def __init__(self, rate, band=(300., 3000.), order=2, window=0.01, k=6.0,
+                 k_offset=None, noise_time=1.0, min_sigma=5.0):
+        from scipy.signal import butter
+
+        nyquist = rate / 2.
+        self.b, self.a = butter(order, [band[0] / nyquist,
+                                        min(band[1] / nyquist, 0.99)],
+                                btype='band')
+        self.zi = np.zeros(max(len(self.a), len(self.b)) - 1)
+
+        alpha = 1 - np.exp(-1. / (window * rate))
+        self.env_b, self.env_a = [alpha], [1, alpha - 1]
+        self.env_zi = np.zeros(1)
+
+        self.rate = rate
+        self.k = k
+        if k_offset is None:
+            k_offset = k / 2.
+        self.k_offset = k_offset
+        self.noise_time = noise_time
+        self.min_sigma = min_sigma
+        self.noise_mean = None
+        self.noise_var = 0.0
+
+    def thresholds(self):
+        sigma = max(np.sqrt(self.noise_var), self.min_sigma)
+        return (self.noise_mean + self.k * sigma,
+                self.noise_mean + self.k_offset * sigma)
+
+    def process(self, chunk, speaking=False):
+        from scipy.signal import lfilter
+
+        filtered, self.zi = lfilter(self.b, self.a, chunk.astype(np.float64),
+                                    zi=self.zi)
+        energy, self.env_zi = lfilter(self.env_b, self.env_a,
+                                      filtered * filtered, zi=self.env_zi)
+        envelope = np.sqrt(energy)
+
+        if self.noise_mean is None:
+            self.noise_mean = envelope.mean()
+            self.noise_var = envelope.var()
+        onset_threshold, offset_threshold = self.thresholds()
+
+        # Only learn the noise floor from noise
+        if not speaking and envelope.max() <= onset_threshold:
+            beta = 1 - np.exp(-float(len(chunk)) /
+                              (self.noise_time * self.rate))
+            self.noise_mean += beta * (envelope.mean() - self.noise_mean)
+            self.noise_var += beta * (
+                np.mean((envelope - self.noise_mean) ** 2) - self.noise_var)
+
+        return envelope, onset_threshold, offset_threshold
+
+
+class ChunkPeaks(object):
+    ''' The peak (largest sample) of each chunk of samples, which is what
+    PeakDetector compares against the threshold, for samples that come in
+    pieces of any length.
+
+    update returns the peaks of the chunks completed so far; what's left
+    over is kept, and put in front of the samples of the next update.  flush
+    returns the peak of what's left (an empty array if nothing is).
+    '''
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.remainder = np.zeros(0)
+
+    def update(self, samples):
+        samples = np.asarray(samples)
+        if len(self.remainder):
+            samples = np.concatenate((self.remainder, samples))
+        n = len(samples) // self.chunk_size
+        end = n * self.chunk_size
+        self.remainder = samples[end:]
+        return samples[:end].reshape(n, self.chunk_size).max(axis=1) \
+            .astype(np.float64)
+
+    def flush(self):
+        remainder, self.remainder = self.remainder, np.zeros(0)
+        if not len(remainder):
+            return np.zeros(0)
+        return np.array([remainder.max()], dtype=np.float64)
+
+
+def chunk_peaks(samples, chunk_size):
+    ''' The peak of each chunk of samples, including the last, partial one
+    (see ChunkPeaks) '''
+    peaks = ChunkPeaks(chunk_size)
+    return np.concatenate((peaks.update(samples), peaks.flush()))
+
+
+def calibrate_threshold(noise, speech=None, chunk_size=800, percentile=99.0,
+                        margin=1.5):
+    ''' Choose a PeakDetector threshold from recordings of ambient noise
+    and (optionally) speech, both arrays of int16 samples.
+
+    The threshold is margin times the given percentile of the noise's chunk
+    peaks.  If there's a speech sample and that would be over the median
+    speech peak, it's lowered to halfway between the two (on a log scale),
+    so that speech still triggers.
+
+    Returns the threshold and a dict of the stats it was based on.
+    '''
+    noise_peaks = chunk_peaks(noise, chunk_size)
+    noise_level = np.percentile(noise_peaks, percentile)
+    threshold = max(1.0, margin * noise_level)
+    stats = {'noise_chunks': len(noise_peaks),
+             'noise_peak_median': float(np.median(noise_peaks)),
+             'noise_peak_percentile': float(noise_level),
+             'noise_peak_max': float(noise_peaks.max()),
+             'noise_rms': float(np.sqrt(np.mean(
+                 np.asarray(noise, dtype=np.float64) ** 2))),
+             'percentile': percentile,
+             'margin': margin}
+
+    if speech is not None and len(speech):
+        speech_peaks = chunk_peaks(speech, chunk_size)
+        speech_level = np.median(speech_peaks)
+        stats['speech_peak_median'] = float(speech_level)
+        stats['speech_peak_max'] = float(speech_peaks.max())
+        stats['snr_db'] = float(20 * np.log10(
+            max(speech_level, 1) / max(noise_level, 1)))
+        if threshold >= speech_level:
+            threshold = np.sqrt(max(noise_level, 1) * max(speech_level, 1))
+        # how much of the speech would (and noise wouldn't) trigger
+        stats['speech_over_threshold'] = float(
+            np.mean(speech_peaks > threshold))
+
+    stats['noise_over_threshold'] = float(np.mean(noise_peaks > threshold))
+    return int(np.ceil(threshold)), stats
+
+
+class TriggerDebouncer(object):
+    ''' A little state machine that turns chunks of audio into exactly one
+    onset (and one offset) per utterance, rather than a trigger for every loud
+    chunk.
+
+    An utterance starts when the signal goes over the onset threshold, but
+    only counts if it stays over the (lower) offset threshold for at least
+    min_duration - so clicks and plosives don't trigger.  It ends once the
+    signal has been under the offset threshold for offset_hold seconds (so
+    short pauses within a word don't end it).  After that, nothing can
+    trigger for refractory seconds.
+
+    Onsets and offsets are found to the sample, using numpy on each chunk.
+    '''
+    QUIET, CANDIDATE, SPEAKING, REFRACTORY = range(4)
+
+    def __init__(self, rate, min_duration=0.0, offset_hold=0.15,
+                 refractory=0.0):
+        self.min_samples = int(min_duration * rate)
+        self.hold_samples = int(offset_hold * rate)
+        self.refractory_samples = int(refractory * rate)
+
+        self.state = self.QUIET
+        self.onset_sample = None  # where the present utterance started
+        self.last_loud = None  # last sample over the offset threshold
+        self.refractory_end = None
+
+    def update(self, chunk, start, onset_threshold, offset_threshold):
+        ''' Process a chunk whose first sample is sample number start.
+        Returns a list of ('onset', onset sample) and ('offset', onset sample,
+        offset sample) for anything that happened.
+        '''
+        events = []
+        end = start + len(chunk)
+
+        if self.state == self.REFRACTORY:
+            if end <= self.refractory_end:
+                return events
+            skip = max(0, self.refractory_end - start)
+            chunk = chunk[skip:]
+            start += skip
+            self.state = self.QUIET
+
+        if self.state == self.QUIET:
+            loud = np.flatnonzero(chunk > onset_threshold)
+            if not len(loud):
+                return events
+            self.onset_sample = self.last_loud = start + loud[0]
+            self.state = self.CANDIDATE
+
+        loud = np.flatnonzero(chunk > offset_threshold)
+        if len(loud):
+            self.last_loud = max(self.last_loud, start + loud[-1])
+
+        if self.state == self.CANDIDATE:
+            if self.last_loud - self.onset_sample >= self.min_samples:
+                events.append(('onset', self.onset_sample))
+                self.state = self.SPEAKING
+            elif end - self.last_loud > self.hold_samples:
+                # too short to be speech
+                self.state = self.QUIET
+
+        if self.state == self.SPEAKING and \
+                end - self.last_loud > self.hold_samples:
+            events.append(('offset', self.onset_sample, self.last_loud))
+            self.state = self.REFRACTORY
+            self.refractory_end = self.last_loud + self.refractory_samples
+
+        return events
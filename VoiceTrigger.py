@@ -5,6 +5,7 @@ To be sure that your stim timing goes smoothly, ALWAYS try to save your sound
 file at a time when nothing else is happening by specifying its duration to not
 overlap with other important events. Save sounds from your experiment script using
 voice_controller.write_soundfiles(). See VT_test_exp.py for an example.
+Or, with save_in_background=True, they're saved on a separate thread as you go.
 
 You sometimes see a few lines of the "[Errno Input overflowed] -9981" upon startup,
 but it doesn't seem to affect anything. Fiddle with CHUNK_SIZE to change these --
@@ -19,6 +20,11 @@ logfile that tells you the filename of the sound file for that trial. Sound file
 are saved to the working directory, and are 2 sec long by default.
 
 Records the sound file from the start of the noise, not the start of the trial.
+A short pre_trigger window (0.2 sec by default) before the noise is included,
+so the onset of speech isn't cut off.
+
+Finished recordings are kept in memory up to a memory budget, and after that in
+a memory-mapped scratch file, so long sessions don't fill up RAM.
 
 -- Geoff.Brookshire@gmail.com (5-24-2012)
 
@@ -26,18 +32,26 @@ Records the sound file from the start of the noise, not the start of the trial.
 
 import sys
 import cognac.StimController
+from cognac.StimController import dispatcher
+from cognac.VoiceDetection import TriggerDebouncer, EnergyDetector, \
+                                  calibrate_threshold
+from cognac.AudioSource import PyAudioSource, CONTINUE, INPUT_OVERFLOW, \
+                               INPUT_OVERFLOWED
+from cognac.SoundWriter import SoundWriter, wav_bytes
 import VisionEgg.FlowControl as Flow
 import VisionEgg.ParameterTypes as ve_types
-import pyaudio
 import pygame
 from pygame.locals import KEYDOWN, K_RIGHT, K_LEFT, K_ESCAPE, K_RETURN
-from struct import pack, unpack
-from array import array
+import numpy as np
 import time
-import wave
+import tempfile
+import threading
+from collections import deque
 
 # make a user-defined voice-trigger event
 VOICE_TRIGGER_EVENT = pygame.USEREVENT + 1
+# and one for the end of an utterance, with its duration
+VOICE_OFFSET_EVENT = pygame.USEREVENT + 2
 
 class VoiceResponse(cognac.StimController.Response): 
     ''' 
@@ -45,12 +59,15 @@ class VoiceResponse(cognac.StimController.Response):
     Logs RTs from an auditory trigger read.
     '''
 
-    def __init__(self, label, audio_controller): 
+    def __init__(self, label, audio_controller, channel=None): 
         cognac.StimController.Response.__init__(self, label) 
 
         self.response_type = VOICE_TRIGGER_EVENT
         self.controller = audio_controller
-        self.unlogged = ('limit', 'label', 'response_type', 'controller', 'unlogged')
+        # only respond to triggers from this channel (None for any)
+        self.listen_channel = channel
+        self.unlogged = ('limit', 'label', 'response_type', 'controller',
+                         'listen_channel', 'unlogged')
 
 
     def record_response(self, t):
@@ -60,18 +77,94 @@ class VoiceResponse(cognac.StimController.Response):
 
         Store a voice-triggered RT and the name that will be used for
         that trial's soundfile.
+
+        If the controller could work out when the threshold was actually
+        crossed (see VoiceTriggerController.sample_time), that time is logged
+        as onset and the RT is measured from it.  Otherwise the RT is from the
+        frame the trigger was seen on.
+
+        With more than one channel, the channel is logged too.
         '''
 
-        responses = pygame.event.get(self.response_type) # check for voice trigs
-        pygame.event.clear()
-        if responses:
-            self.filename = responses[0].filename
-            self.rt = t - self.ref_time
+        for stamp, event in self.get_events(t): # check for voice trigs
+            channel = getattr(event, 'channel', 0)
+            if self.listen_channel is not None and \
+                    channel != self.listen_channel:
+                continue
+            if self.controller.channels > 1:
+                self.channel = channel
+            onset = getattr(event, 'onset', None)
+            if onset is not None:
+                if onset < self.ref_time:
+                    # the noise started before we were listening
+                    continue
+                self.onset = onset
+                stamp = onset
+            self.filename = event.filename
+            self.rt = stamp - self.ref_time
             return True
 
         return False
 
 
+class ClipStore(object):
+    ''' Finished recordings waiting to be saved, all the same number of
+    samples (and channels).
+
+    Clips are kept in preallocated blocks of block_size clips each. Blocks are
+    in memory until memory_budget (in bytes) is used up, after that they are
+    numpy memmaps on scratch files in scratch_dir (or the system temp
+    directory), which the OS can page out.
+    '''
+    block_size = 16
+
+    def __init__(self, clip_samples, memory_budget=64 * 2**20,
+                 scratch_dir=None, channels=1):
+        self.clip_samples = clip_samples
+        self.channels = channels
+        self.memory_budget = memory_budget
+        self.scratch_dir = scratch_dir
+        # int16 arrays, block_size x clip_samples x channels
+        self.blocks = []
+        self.names = []  # filename for each clip, in order
+        self.bytes_in_memory = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def new_block(self):
+        block_bytes = self.block_size * self.clip_samples * self.channels * 2
+        shape = (self.block_size, self.clip_samples, self.channels)
+        if self.bytes_in_memory + block_bytes <= self.memory_budget:
+            block = np.empty(shape, dtype=np.int16)
+            self.bytes_in_memory += block_bytes
+        else:
+            scratch = tempfile.TemporaryFile(dir=self.scratch_dir)
+            block = np.memmap(scratch, dtype=np.int16, mode='w+', shape=shape)
+        self.blocks.append(block)
+
+    def new_clip(self, name):
+        ''' Returns a (writable) array to put the samples for clip name in
+        '''
+        i = len(self.names)
+        if i == len(self.blocks) * self.block_size:
+            self.new_block()
+        self.names.append(name)
+        return self.blocks[i // self.block_size][i % self.block_size]
+
+    def items(self):
+        ''' (name, samples) for each clip, in the order they were recorded
+        '''
+        for i, name in enumerate(self.names):
+            yield name, self.blocks[i // self.block_size][i % self.block_size]
+
+    def clear(self):
+        # memmaps close their scratch files when they're garbage collected
+        self.blocks = []
+        self.names = []
+        self.bytes_in_memory = 0
+
+
 class VoiceTriggerController(Flow.Controller):
     ''' VisionEgg.Controller class to check for voice-trigger events
     and post them to the pygame event queue.
@@ -79,7 +172,8 @@ class VoiceTriggerController(Flow.Controller):
     To use, add an instance of this controller to the visionegg presentation using:
     ...presentation.add_controller(None, None, voice_controller_instance)
 
-    Includes a method for setting the trigger threshold (set_threshold_gui).
+    Includes methods for setting the trigger threshold, automatically
+    (calibrate) or by hand (set_threshold_gui).
 
     This class reads the audio stream at a rate determined by the sampling
     rate and the chunk size. Each call to stream.read will take this much time:
@@ -99,40 +193,274 @@ class VoiceTriggerController(Flow.Controller):
     called from your experiment script! Do this at a time when saving files won't
     interfere with the timing of the stims/responses.
 
-    '''
+    Trigger events carry the sample number where the threshold was crossed
+    (sample), and that sample's time on the same clock as the Trial's t
+    (onset).  That comes from PortAudio's ADC timestamps (or the stream time
+    when a blocking read returns), mapped onto t each frame.  Set
+    latency_compensation to any extra input latency (in seconds) you've
+    measured for your hardware, and it will be subtracted.
+
+    Triggers are debounced (see TriggerDebouncer), so you get one
+    VOICE_TRIGGER_EVENT at the start of each utterance and one
+    VOICE_OFFSET_EVENT (with its duration) at the end.  offset_threshold
+    defaults to half of threshold.
+
+    With channels > 1, each channel (e.g., a microphone for each participant)
+    gets its own trigger detection - threshold, offset_threshold and detector
+    can be a list with one for each channel.  Trigger events have the channel
+    they came from (channel), and a VoiceResponse can be made to listen to
+    only one channel.  Recordings (started by a trigger on any channel) have
+    all of the channels, and are saved as multichannel WAV files, or one file
+    per channel (N_chC.wav) with split_channels=True.
+
+    By default, a trigger is the raw signal going over threshold.  With
+    detector='energy', an EnergyDetector is used instead - band-limited
+    energy against an adaptive noise floor, which copes much better with hum
+    and background noise (needs scipy; threshold is then not used).  Any
+    object with the same process method as those in cognac.VoiceDetection
+    can be passed too.
+
+    With callback_mode=True, none of the above chunk size juggling is needed.
+    The source calls us from its own thread with each chunk, which goes into a
+    preallocated ring buffer (ring_duration seconds long) and is checked for
+    triggers right there.  All the frame loop does is look at the sample
+    number of the last trigger, so reading audio never holds up a frame, and
+    the stream is never stopped and started (which is where the overflows
+    come from).
+
+    With save_in_background=True, each recording is handed to a SoundWriter
+    (see cognac.SoundWriter) as soon as it's finished, which saves it on its
+    own thread, so there's no need to wait for write_soundfiles.  Give a
+    container filename to save all of them in a single zip file instead of
+    loose WAV files.  Call close() at the end of the session to make sure
+    everything is saved; writer.stats() has the save latencies.  To resample
+    or compress the recordings as they're saved, pass your own writer, e.g.:
+
+        writer=SoundWriter(44100, container='s01.zip', target_rate=16000,
+                           sample_format='flac')
+
+    Audio comes from the microphone, through PyAudio, unless you give a
+    source (see cognac.AudioSource) - e.g., a WavSource or SyntheticSource,
+    to try things out without any sound hardware.
 
-    FORMAT = pyaudio.paInt16
+    '''
 
     def __init__(self, rec_duration=2,
                  threshold=1000,
                  chunk_size=800,
-                 rate=44100): 
+                 rate=44100,
+                 callback_mode=False,
+                 ring_duration=None,
+                 pre_trigger=0.2,
+                 memory_budget=64 * 2**20,
+                 scratch_dir=None,
+                 latency_compensation=0.0,
+                 offset_threshold=None,
+                 min_duration=0.0,
+                 offset_hold=0.15,
+                 refractory=0.0,
+                 detector=None,
+                 source=None,
+                 save_in_background=False,
+                 container=None,
+                 channels=1,
+                 split_channels=False,
+                 writer=None): 
 
         # initialize a few important variables
+        self.channels = channels
+        if np.iterable(threshold):  # one for each channel
+            threshold = np.array(threshold, dtype=float)
         self.THRESHOLD = threshold  # amplitude that triggers a pygame event
         self.CHUNK_SIZE = chunk_size  # no. of samples to read from stream
         self.RATE = rate  # sampling rate of the audio stream
         self.rec_duration = rec_duration  # how long to record for
+        self.pre_trigger = pre_trigger  # how much to record before the trigger
         self.rec_onset_time = None # time the present recording began
-        self.rec_array = array('h')  # holds the temporary audio data
+        self.peak = 0  # max amplitude of the last chunk read
+        self.peaks = np.zeros(channels)  # the same, for each channel
+        self.rms = 0.0  # RMS amplitude of the last chunk read
         self.soundfile_path = 0  # number is converted to a string for filenames
         self.recording = False  # is it recording the stream to disk
-        self.sounds_to_save = {} # dict - holds filenames and sounds to save
-
-        pa = pyaudio.PyAudio()  # initialize pyaudio and open an audio stream
-        self.sample_width = pa.get_sample_size(self.FORMAT) 
-        self.stream = pa.open(format=self.FORMAT, channels=1,
-                              rate=self.RATE,
-                              input=True, output=False,
-                              frames_per_buffer = self.CHUNK_SIZE) 
+        # holds filenames and sounds to save
+        self.rec_samples = int((pre_trigger + rec_duration) * self.RATE)
+        self.clips = ClipStore(self.rec_samples, memory_budget, scratch_dir,
+                               channels)
+        # the audio thread adds clips while write_soundfiles saves them
+        self.clips_lock = threading.Lock()
+        # recordings that were gone from the ring buffer before they could be
+        # copied out (filenames)
+        self.dropped_clips = []
+        self.split_channels = split_channels
+
+        # All audio goes through the ring buffer, recordings are copied from it
+        self.callback_mode = callback_mode
+        if ring_duration is None:  # plenty of time to copy out a recording
+            ring_duration = max(4, 2 * (pre_trigger + rec_duration))
+        elif ring_duration < pre_trigger + rec_duration:
+            raise ValueError('ring_duration must be at least pre_trigger + '
+                             'rec_duration')
+        # a row for each sample, a column for each channel
+        self.ring = np.zeros((int(ring_duration * self.RATE), channels),
+                             dtype=np.int16)
+        self.samples_written = 0  # total samples put in the ring buffer
+        # onsets / offsets waiting to be posted by the frame loop (appended by
+        # the audio thread in callback mode)
+        self.triggers = deque()
+        if np.iterable(offset_threshold):
+            offset_threshold = np.array(offset_threshold, dtype=float)
+        self.offset_threshold = offset_threshold
+        self.debouncers = [TriggerDebouncer(self.RATE, min_duration,
+                                            offset_hold, refractory)
+                           for c in range(channels)]
+        # None means the peak amplitude vs THRESHOLD
+        if isinstance(detector, (list, tuple)):
+            self.detectors = list(detector)
+        elif detector == 'energy':
+            self.detectors = [EnergyDetector(self.RATE)
+                              for c in range(channels)]
+        elif detector is None or channels == 1:
+            self.detectors = [detector] * channels
+        else:
+            raise ValueError('give a detector for each channel')
+        # soundfile for the present utterance, on each channel
+        self.utterance_filenames = [None] * channels
+        self.rec_start_sample = None  # where the present recording began
+        self.overflow_count = 0  # chunks PortAudio says overflowed
+        self.calibrating = False  # don't look for triggers while calibrating
+
+        # For mapping sample numbers onto the Trial clock
+        self.latency_compensation = latency_compensation
+        # (sample number, stream time) of the latest chunk, set together
+        self.sample_clock = None
+        self.clock_offset = None  # Trial t - stream time
+        self.last_t = None
+
+        if source is None:  # the microphone
+            source = PyAudioSource()
+        if callback_mode:
+            stream_callback = self.audio_callback
+        else:
+            stream_callback = None
+        # audio_callback uses self.stream, so it has to be set before the
+        # source starts calling it
+        self.stream = source
+        source.open(self.RATE, self.CHUNK_SIZE, stream_callback, channels)
+        self.sample_width = source.sample_width
+
+        if writer is None and (save_in_background or container is not None):
+            writer = SoundWriter(self.RATE, self.sample_width,
+                                 container=container)
+        self.writer = writer
 
         Flow.Controller.__init__(self,
             return_type = ve_types.get_type(None),
             eval_frequency = Flow.Controller.EVERY_FRAME,
             temporal_variables = Flow.Controller.TIME_SEC_SINCE_GO)
 
+        source.start()
+
 
-    def set_threshold_gui(self, display_scale=0.03):
+    def record_seconds(self, duration):
+        ''' Record duration seconds from the stream, returning the samples
+        (a column for each channel).  No triggers are detected in the
+        meantime.
+        '''
+        out = np.empty((int(duration * self.RATE), self.channels),
+                       dtype=np.int16)
+        got = 0
+        # calibrate keeps it set for longer
+        was_calibrating = self.calibrating
+        self.calibrating = True
+        try:
+            if self.callback_mode:
+                # The audio thread fills the ring, we copy out as it does
+                start = self.samples_written
+                last_data = time.time()
+                while got < len(out):
+                    time.sleep(0.01)
+                    avail = min(self.samples_written - start, len(out))
+                    if avail > got:
+                        self.ring_copy(start + got, out[got:avail])
+                        got = avail
+                        last_data = time.time()
+                    elif time.time() - last_data > 1.0:
+                        raise IOError('no audio from the stream - '
+                                      'is it started?')
+            else:
+                while got < len(out):
+                    try:
+                        x = self.stream.read(self.CHUNK_SIZE)
+                    except IOError, e:
+                        print e
+                        continue
+                    chunk = np.frombuffer(x, dtype='<i2').reshape(
+                        -1, self.channels)[:len(out) - got]
+                    self.write_ring(chunk)
+                    out[got:got + len(chunk)] = chunk
+                    got += len(chunk)
+        finally:
+            self.calibrating = was_calibrating
+        return out
+
+    def calibrate(self, noise_duration=3.0, speech_duration=0.0,
+                  percentile=99.0, margin=1.5, verbose=True):
+        ''' Set the threshold without anyone having to fiddle with it.
+
+        Records noise_duration seconds of ambient noise, then (if
+        speech_duration) that long of the participant talking, and sets
+        THRESHOLD with calibrate_threshold (see cognac.VoiceDetection).
+        Returns the threshold and its stats (lists of them, for each channel,
+        if there's more than one).
+
+        If there's a detector (e.g., detector='energy'), the noise is also run
+        through it, so it starts out knowing the noise floor.  That's done
+        while we're still calibrating, so the audio thread (in callback mode)
+        isn't using the detector at the same time.
+        '''
+        if verbose:
+            print "Calibrating the voice trigger - please stay quiet."
+        self.calibrating = True
+        try:
+            noise = self.record_seconds(noise_duration)
+            speech = None
+            if speech_duration:
+                if verbose:
+                    print "Now please say a few words, until told to stop."
+                speech = self.record_seconds(speech_duration)
+                if verbose:
+                    print "Thanks, that's it."
+
+            thresholds = []
+            stats = []
+            for c in range(self.channels):
+                if speech is None:
+                    channel_speech = None
+                else:
+                    channel_speech = speech[:, c]
+                channel_threshold, channel_stats = calibrate_threshold(
+                    noise[:, c], channel_speech, self.CHUNK_SIZE, percentile,
+                    margin)
+                thresholds.append(channel_threshold)
+                stats.append(channel_stats)
+
+                detector = self.detectors[c]
+                if detector is not None:
+                    for i in xrange(0, len(noise), self.CHUNK_SIZE):
+                        detector.process(noise[i:i + self.CHUNK_SIZE, c])
+
+            if self.channels == 1:
+                threshold, stats = thresholds[0], stats[0]
+            else:
+                threshold = np.array(thresholds, dtype=float)
+            self.THRESHOLD = threshold
+        finally:
+            self.calibrating = False
+        if verbose:
+            print "Threshold is set to", threshold, stats
+        return threshold, stats
+
+    def set_threshold_gui(self, display_scale=0.03, calibrate=False):
         """ Open up a pygame gui to set the threshold for the voice trigger. 
         The line turns red if a pygame event is detected, i.e. if the threshold
         is exceeded. Use the left and right arrows to avoid having this happen. 
@@ -141,7 +469,20 @@ class VoiceTriggerController(Flow.Controller):
         display_scale determines how much space is devoted to amplitude (smaller
         numbers mean that ambient noise fills up less of the scale)
 
+        With calibrate=True, start from the threshold calibrate() finds.
+        (calibrate() on its own does the job without a gui.)
+
+        There's only one threshold line, so this is for one channel only -
+        with more, use calibrate() (or set THRESHOLD to one per channel).
+
         """ 
+        if self.channels > 1 or np.ndim(self.THRESHOLD):
+            raise ValueError('set_threshold_gui only handles one channel '
+                             '(this has %d) - use calibrate() to set a '
+                             'threshold for each' % self.channels)
+        if calibrate:
+            self.calibrate()
+
         from numpy import mean
 
         msg = """
@@ -196,9 +537,9 @@ class VoiceTriggerController(Flow.Controller):
             stream_data = self.read_stream() 
 
             # get the lines ready to draw
-            if stream_data:
+            if stream_data is not None:
                 mean_vol = [mean(stream_data) * display_scale, screen_center[1]]
-                max_vol = [max(stream_data) * display_scale, screen_center[1]]
+                max_vol = [self.peak * display_scale, screen_center[1]]
             else:
                 mean_vol = [0, screen_center[1]]
                 max_vol = [0, screen_center[1]] 
@@ -221,74 +562,287 @@ class VoiceTriggerController(Flow.Controller):
         pygame.quit()  # quit this pygame session when the loop ends
         self.CHUNK_SIZE = old_chunk_size # reset the chunk size for pyaudio
 
-    def record_sound(self, sound_chunk): 
-        ''' Add data to the temporary sound array while recording.
-        When the recording time is finished, close and store the
-        sound data in a dict of all the sound data along with the
-        filename which it will be saved with.
+    def record_sound(self): 
+        ''' When the recording time is finished, copy the recording out of the
+        ring buffer into the next clip in self.clips, along with the filename
+        which it will be saved with.
+
+        This is called as each chunk goes into the ring buffer (on the audio
+        thread, in callback mode), so a recording is copied out as soon as
+        it's complete - however long it is until the next frame.
 
         It disrupts timing to save files to disk during the exp.
         Instead, save the sounds in RAM until a point when they
-        can be saved without jeopardizing timing. Keep a list of the
-        sound chunks to be saved, and write them to disk
+        can be saved without jeopardizing timing. Write them to disk
         with voice_controller_instance.write_soundfiles().
 
         '''
+        if not self.recording or \
+                self.samples_written - self.rec_start_sample < self.rec_samples:
+            return
+        filename = str(self.soundfile_path) + '.wav'
+        if self.rec_start_sample < self.samples_written - len(self.ring):
+            # Shouldn't happen, but if it does, it's not worth stopping the
+            # experiment for
+            print 'VoiceTriggerController: lost recording', filename
+            self.dropped_clips.append(filename)
+        elif self.writer is not None:
+            clip = np.empty((self.rec_samples, self.channels),
+                            dtype=np.int16)
+            self.ring_copy(self.rec_start_sample, clip)
+            for name, samples in self.clip_files(filename, clip):
+                self.writer.put(name, samples)
+        else:
+            self.clips_lock.acquire()
+            try:
+                self.ring_copy(self.rec_start_sample,
+                               self.clips.new_clip(filename))
+            finally:
+                self.clips_lock.release()
+        self.soundfile_path += 1  # increment soundfile name
+        self.rec_onset_time = None
+        self.rec_start_sample = None
+        self.recording = False
+
+    def ring_copy(self, start, out):
+        ''' Copy len(out) samples, starting at sample number start (counted
+        from when the stream started), out of the ring buffer into out.
+        '''
+        size = len(self.ring)
+        n = len(out)
+        if n > size or start < self.samples_written - size:
+            raise ValueError('samples %d:%d are no longer in the ring buffer'
+                             % (start, start + n))
+        i = start % size
+        first = min(n, size - i)
+        out[:first] = self.ring[i:i + first]
+        out[first:] = self.ring[:n - first]
+        return out
+
+    def ring_slice(self, start, stop):
+        ''' Copy samples start:stop out of the ring buffer into a new array
+        '''
+        return self.ring_copy(start, np.empty((stop - start, self.channels),
+                                              dtype=np.int16))
+
+    def clip_files(self, filename, clip):
+        ''' (filename, samples) for each file to save clip in - just the one,
+        unless we're splitting channels.
+        '''
+        if not self.split_channels or self.channels == 1:
+            return [(filename, clip)]
+        base = filename[:-len('.wav')]
+        return [('%s_ch%d.wav' % (base, c), clip[:, c])
+                for c in range(self.channels)]
+
+    def write_ring(self, chunk):
+        ''' Put a chunk in the ring buffer, returning the sample number of its
+        first sample.
+        '''
+        start = self.samples_written
+        size = len(self.ring)
+        i = start % size
+        first = min(len(chunk), size - i)
+        self.ring[i:i + first] = chunk[:first]
+        self.ring[:len(chunk) - first] = chunk[first:]
+        # only count the samples once they're actually there
+        self.samples_written = start + len(chunk)
+        return start
+
+    def start_recording(self, trigger_sample):
+        if not self.recording:
+            # include pre_trigger, as far as we have it
+            self.rec_start_sample = max(
+                trigger_sample - int(self.pre_trigger * self.RATE),
+                self.samples_written - len(self.ring), 0)
+            # on the Trial clock, like the trigger onset
+            self.rec_onset_time = self.sample_time(self.rec_start_sample)
+            self.recording = True
+
+    def sample_time(self, sample):
+        ''' The time that sample number sample was captured, on the same clock
+        as the t passed to StimController (i.e., VisionEgg's time since go).
+        None if we don't know the clocks' relation yet.
+        '''
+        if self.sample_clock is None or self.clock_offset is None:
+            return None
+        anchor_sample, anchor_time = self.sample_clock
+        return anchor_time + float(sample - anchor_sample) / self.RATE + \
+            self.clock_offset - self.latency_compensation
+
+    def update_clock(self):
+        ''' Relate the stream clock to the frame clock, called once a frame.
+        t was read a bit before now, so t - stream time is a little low; the
+        largest value we've seen in this go is the best estimate.
+        '''
+        t = self.time_sec_since_go
+        offset = t - self.stream.get_time()
+        if self.clock_offset is None or offset > self.clock_offset or \
+                t < self.last_t:  # t < last_t means a new go
+            self.clock_offset = offset
+        self.last_t = t
+
+    def detect(self, chunk, start):
+        ''' Check a chunk (a column for each channel) for the start or end of
+        an utterance, leaving anything we find in self.triggers (with the
+        channel and soundfile name) for check_trigger.
+
+        Recordings start here, rather than when the frame loop gets around
+        to the trigger, so pre_trigger is still in the ring buffer however
+        long that takes (e.g., over a pause between trials).
+        '''
+        # One pass over all the channels finds the quiet ones, which (with
+        # the peak detector) we needn't look at any further
+        peaks = chunk.max(axis=0)
+        self.peaks = peaks
+        self.peak = peaks.max()
+        if self.calibrating:
+            return
+
+        channels = self.channels
+        onset_thresholds = self.THRESHOLD * np.ones(channels)
+        offset_thresholds = self.offset_threshold
+        if offset_thresholds is None:
+            offset_thresholds = onset_thresholds / 2
+        else:
+            offset_thresholds = offset_thresholds * np.ones(channels)
+
+        for c in range(channels):
+            debouncer = self.debouncers[c]
+            detector = self.detectors[c]
+            if detector is None:
+                if debouncer.state == TriggerDebouncer.QUIET and \
+                        peaks[c] <= onset_thresholds[c]:
+                    continue
+                # a strided view on the channel, not a copy
+                signal = chunk[:, c]
+                onset_threshold = onset_thresholds[c]
+                offset_threshold = offset_thresholds[c]
+            else:
+                speaking = debouncer.state != TriggerDebouncer.QUIET
+                signal, onset_threshold, offset_threshold = \
+                    detector.process(chunk[:, c], speaking)
+            for trigger in debouncer.update(signal, start, onset_threshold,
+                                            offset_threshold):
+                if trigger[0] == 'onset':
+                    filename = self.soundfile_path
+                    self.utterance_filenames[c] = filename
+                    self.start_recording(trigger[1])
+                else:
+                    filename = self.utterance_filenames[c]
+                self.triggers.append((trigger, c, filename))
+
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        ''' Called by PyAudio, on its own thread, with each chunk of audio in
+        callback mode.  Puts the chunk in the ring buffer and checks it for a
+        trigger, leaving it in self.triggers for the frame loop to pick up.
+        '''
+        # de-interleaved, without copying
+        chunk = np.frombuffer(in_data, dtype='<i2').reshape(-1, self.channels)
+        start = self.write_ring(chunk)
 
-        self.rec_array.extend(sound_chunk)  # add present chunk to the sound array
+        adc_time = time_info.get('input_buffer_adc_time')
+        if adc_time is None:  # some host APIs don't give us this
+            adc_time = time_info['current_time'] - \
+                self.stream.get_input_latency()
+        self.sample_clock = (start, adc_time)
 
-        # if the time is up, close the object and save the file
-        rec_time = time.time() - self.rec_onset_time  # duration of present rec. 
-        if  rec_time > self.rec_duration: 
-            self.stream.stop_stream()  # save CPU power until done saving the file
-            self.recording = False
-            self.rec_onset_time = None
+        if status & INPUT_OVERFLOW:
+            self.overflow_count += 1
 
-            # close the recording, save it
-            sound_data = pack('<' + ('h' * len(self.rec_array)), *self.rec_array)
+        self.detect(chunk, start)
+        self.record_sound()
 
-            filename = str(self.soundfile_path) + '.wav'
-            self.sounds_to_save[filename] = sound_data
+        return (None, CONTINUE)
 
-            self.rec_array = array('h') # re-initialize the recording array
-            self.soundfile_path += 1  # increment soundfile name
-            self.stream.start_stream()  # start up the stream again
+    def check_trigger(self):
+        ''' Post events for any onsets or offsets that detect found since the
+        last time.
+        '''
+        triggers = self.triggers
+        while triggers:
+            trigger, channel, filename = triggers.popleft()
+            if trigger[0] == 'onset':
+                trigger_sample = trigger[1]
+                vt_event = pygame.event.Event(VOICE_TRIGGER_EVENT,
+                                  {'filename': filename,
+                                   'sample': trigger_sample,
+                                   'onset': self.sample_time(trigger_sample),
+                                   'channel': channel})
+            else:
+                onset_sample, offset_sample = trigger[1:3]
+                vt_event = pygame.event.Event(VOICE_OFFSET_EVENT,
+                          {'filename': filename,
+                           'sample': offset_sample,
+                           'offset': self.sample_time(offset_sample),
+                           'duration': float(offset_sample - onset_sample) /
+                                       self.RATE,
+                           'channel': channel})
+            pygame.event.post(vt_event) # send the pygame event
 
     def write_soundfiles(self):
-        ''' Save the sound data in self.sounds_to_save to disk.
+        ''' Save the sound data in self.clips to disk.
 
+        When saving in the background, this just waits until everything
+        recorded so far has been saved.
         '''
-        for fname, s_data in self.sounds_to_save.iteritems():
-            wf = wave.open(fname, 'wb')
-            wf.setnchannels(1)
-            wf.setsampwidth(self.sample_width)
-            wf.setframerate(self.RATE)
-            wf.writeframes(s_data)
-            wf.close() 
+        if self.writer is not None:
+            self.writer.flush()
+            return
+
+        self.clips_lock.acquire()
+        try:
+            for filename, clip in self.clips.items():
+                for fname, s_data in self.clip_files(filename, clip):
+                    f = open(fname, 'wb')
+                    f.write(wav_bytes(s_data, self.RATE, self.sample_width))
+                    f.close()
 
-        self.sounds_to_save = {} # clear the sound data after saving
+            self.clips.clear() # clear the sound data after saving
+        finally:
+            self.clips_lock.release()
 
 
     def read_stream(self):
         """ Read the audio stream, check for voice triggers, handle any errors.
-        Return an array containing sound data.
+        Return a numpy array containing sound data, with a column for each
+        channel (or None if the read failed).
+
+        The array is a view on the buffer the source gives us - no copying or
+        unpacking.  Peak and RMS amplitude are computed in numpy and kept in
+        self.peak and self.rms.
+
+        In callback mode, this returns the most recent chunk from the ring
+        buffer instead of reading (which would fail).
         """
+        if self.callback_mode:
+            self.check_trigger()
+            if self.samples_written < self.CHUNK_SIZE:
+                return None
+            return self.ring_slice(self.samples_written - self.CHUNK_SIZE,
+                                   self.samples_written)
+
         stream_data = None
 
         try:
             x = self.stream.read(self.CHUNK_SIZE)
-            stream_data = unpack('<' + ('h' * (len(x)/2)), x) # little endian, signed short
-            stream_data = array('h', stream_data) 
-            if max(stream_data) > self.THRESHOLD:
-                vt_event = pygame.event.Event(VOICE_TRIGGER_EVENT,
-                                              {'filename': self.soundfile_path})
-                pygame.event.post(vt_event) # send the pygame event
-                if not self.recording:
-                    self.rec_onset_time = time.time() 
-                    self.recording = True
+            # little endian, signed short, de-interleaved without copying
+            stream_data = np.frombuffer(x, dtype='<i2').reshape(
+                -1, self.channels)
+            start = self.write_ring(stream_data)
+            # The read returns once the last sample is in, so the first one
+            # was captured about this long ago
+            self.sample_clock = (start, self.stream.get_time() -
+                                 self.stream.get_input_latency() -
+                                 float(len(stream_data)) / self.RATE)
+            samples = stream_data.astype(np.float32).ravel()
+            self.rms = np.sqrt(np.dot(samples, samples) / len(samples))
+            self.detect(stream_data, start)
+            self.check_trigger()
+            self.record_sound()
 
         except IOError, e:  # Not sure why this error occurs, but it does often
-            if e[1] == pyaudio.paInputOverflowed:
+            if e[1] == INPUT_OVERFLOWED:
                 print e
                 x = '\x00'*16*256*2 #value*format*chunk*nb_channels 
 
@@ -301,11 +855,22 @@ class VoiceTriggerController(Flow.Controller):
     def during_go_eval(self):
         ''' Read the audio stream and check for voice triggers!
         ''' 
-        pygame.event.clear() 
-        stream_data = self.read_stream() 
-        if self.recording and stream_data: # record the data
-            self.record_sound(stream_data)
-
+        self.update_clock()
+        if self.callback_mode:
+            # The audio thread has done the work, we just check the result
+            self.check_trigger()
+        else:
+            self.read_stream() 
+        # Rather than clearing the queue (and losing key presses), hand this
+        # frame's events to whoever is registered for them
+        dispatcher.drain(self.time_sec_since_go)
+
+
+    def close(self):
+        ''' Stop the audio source, and finish saving '''
+        self.stream.close()
+        if self.writer is not None:
+            self.writer.close()
 
     def between_go_eval(self):
         return None
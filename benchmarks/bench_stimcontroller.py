@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the StimController / Trial / Event hot paths.
+
+Everything runs headless (see HeadlessVisionEgg), so no display is needed.  We
+time each call to StimController.update, i.e., the per-frame cost of the
+experiment engine, varying:
+
+    events      - number of (sequential) events per trial
+    overlap     - number of events active at the same time
+    ref_depth   - length of a chain of events each starting after the
+                  previous event's response
+    pending     - number of events waiting on a single Response
+    stimuli     - number of stimuli in the viewport, a few on at a time
+                  (HeadlessVisionEgg walks through them, as VisionEgg does
+                  when drawing)
+    stimuli_cull - the same, with set_stimuli(cull=True)
+
+and the time for loglines / writelog with lots of trials.
+
+The textures benchmark runs a picture per trial, in real time, with a fake
+loader that takes DECODE seconds a picture.  textures_eager loads them all
+up front, as experiments used to; textures uses a TextureCache.  We report
+the time before the first trial can start (startup_s), the frame times,
+the pictures that weren't ready when they were needed (misses) and the most
+bytes of textures loaded at once (peak_bytes).
+
+Results are written as JSON (one record per benchmark and parameter value),
+so they can be compared across versions:
+
+    python bench_stimcontroller.py -o results.json
+"""
+
+import sys
+import os
+import json
+import time
+import platform
+from timeit import default_timer as timer
+from optparse import OptionParser
+from array import array
+
+from cognac.StimController import Response, Event, Trial, StimController
+from cognac.HeadlessVisionEgg import HeadlessVisionEgg, HeadlessStimulus, \
+                                     SimulatedResponder
+from cognac.TextureCache import TextureCache
+
+
+FRAME_RATE = 60.0
+FRAME = 1 / FRAME_RATE
+# seconds to decode a picture, and its size, for the textures benchmark
+DECODE = 0.005
+PICTURE_SIZE = (1024, 768)
+
+
+def summarize(times):
+    """Stats in microseconds for a sequence of durations in seconds"""
+    times = sorted(times)
+    n = len(times)
+    return {'n': n,
+            'mean_us': 1e6 * sum(times) / n,
+            'median_us': 1e6 * times[n // 2],
+            'p99_us': 1e6 * times[min(n - 1, int(0.99 * n))],
+            'max_us': 1e6 * times[-1]}
+
+
+def time_frames(trials, rt=0.2, stimuli=None, cull=False):
+    """Run trials headless, returning the time for each call to update
+    (and, if there are stimuli, drawing them)"""
+    vision_egg = HeadlessVisionEgg(frame_rate=FRAME_RATE)
+    if stimuli is not None:
+        vision_egg.set_stimuli(stimuli, cull=cull)
+    stim_control = StimController(trials, vision_egg)
+    vision_egg.respond = SimulatedResponder(stim_control, rt=rt)
+
+    # append is outside the timed part, so growing the array doesn't count
+    times = array('d')
+    update = stim_control.update
+    draw = vision_egg.viewport.draw
+    def timed_update(t):
+        start = timer()
+        update(t)
+        draw()
+        times.append(timer() - start)
+
+    vision_egg.set_functions(update=timed_update,
+                             pause_update=stim_control.pause_update)
+    stim_control.run_trials('all')
+    return times
+
+
+def events_trials(n, num_trials=5):
+    """n events, one after the other"""
+    stim = HeadlessStimulus()
+    return [Trial([Event(stim, start=i * FRAME, duration=FRAME)
+                   for i in range(n)])
+            for j in range(num_trials)]
+
+
+def overlap_trials(n, num_trials=5):
+    """n events all on at once, ending one per frame"""
+    stims = [HeadlessStimulus() for i in range(n)]
+    return [Trial([Event(s, start=0, duration=0.5 + i * FRAME)
+                   for i, s in enumerate(stims)])
+            for j in range(num_trials)]
+
+
+def ref_depth_trials(n, num_trials=5):
+    """A chain of n responses, each event starting after the last response"""
+    stim = HeadlessStimulus()
+    trials = []
+    for j in range(num_trials):
+        events = [Event(stim, start=0, duration=0.1,
+                        response=Response('r0', timelimit=1))]
+        for i in range(1, n):
+            events.append(Event(stim, start='r%d+0.05' % (i - 1),
+                                duration=0.1,
+                                response=Response('r%d' % i, timelimit=1)))
+        trials.append(Trial(events))
+    return trials
+
+
+def pending_trials(n, num_trials=5):
+    """n events all waiting on one Response"""
+    stim = HeadlessStimulus()
+    trials = []
+    for j in range(num_trials):
+        events = [Event(stim, start=0, duration=1,
+                        response=Response('press', timelimit=2))]
+        events.extend(Event(stim, start='press+%f' % (i * FRAME),
+                            duration=FRAME)
+                      for i in range(n))
+        trials.append(Trial(events))
+    return trials
+
+
+def stimuli_trials(n, num_trials=5):
+    """n stimuli, with a fixation, a picture and a blank on in each trial,
+    like an experiment with a big set of pictures"""
+    stims = [HeadlessStimulus() for i in range(n)]
+    fixation, blank, pictures = stims[0], stims[1], stims[2:] or stims
+    trials = [Trial([Event(fixation, start=0, duration=0.2),
+                     Event(pictures[j % len(pictures)], start=0.2,
+                           duration=0.2),
+                     Event(blank, start=0.2, duration=0.3)])
+              for j in range(num_trials)]
+    return stims, trials
+
+
+class FakeTexture:
+    def __init__(self, size):
+        self.size = size
+
+
+def fake_load(fname):
+    time.sleep(DECODE)
+    return FakeTexture(PICTURE_SIZE)
+
+
+def time_textures(n, cache=True, budget=8, lookahead=3):
+    """n trials, each showing a different picture for 0.1 s, with the
+    pictures loaded up front, or by a TextureCache holding budget of them.
+    Frames are paced in real time, so the cache has time to load ahead."""
+    pictures = [HeadlessStimulus(texture=None) for i in range(n)]
+    for i, picture in enumerate(pictures):
+        picture.texture_file = 'picture%d.jpg' % i
+    trials = [Trial([Event(picture, start=0.05, duration=0.1)])
+              for picture in pictures]
+
+    vision_egg = HeadlessVisionEgg(frame_rate=FRAME_RATE)
+    start = timer()
+    if cache:
+        texture_cache = TextureCache(budget * 4 * PICTURE_SIZE[0] *
+                                     PICTURE_SIZE[1], lookahead,
+                                     loader=fake_load,
+                                     placeholder=FakeTexture((4, 4)))
+        stim_control = StimController(trials, vision_egg,
+                                      texture_cache=texture_cache)
+    else:
+        texture_cache = None
+        for picture in pictures:
+            picture.set(texture=fake_load(picture.texture_file))
+        stim_control = StimController(trials, vision_egg)
+    startup = timer() - start
+
+    times = array('d')
+    peak = [0]
+    update = stim_control.update
+    def timed_update(t):
+        began = timer()
+        update(t)
+        times.append(timer() - began)
+        if texture_cache:
+            peak[0] = max(peak[0], texture_cache.bytes_used)
+        # wait for the next frame
+        wait = FRAME - (timer() - began)
+        if wait > 0:
+            time.sleep(wait)
+
+    vision_egg.set_functions(update=timed_update,
+                             pause_update=stim_control.pause_update)
+    stim_control.run_trials('all')
+
+    record = {'startup_s': startup}
+    record.update(summarize(times))
+    if texture_cache:
+        texture_cache.close()
+        record.update({'misses': texture_cache.misses,
+                       'peak_bytes': peak[0]})
+    else:
+        record.update({'misses': 0,
+                       'peak_bytes': n * 4 * PICTURE_SIZE[0] *
+                                     PICTURE_SIZE[1]})
+    return record
+
+
+def logged_trials(n):
+    """n trials with filled in logs, as if they'd been run"""
+    trials = []
+    for i in range(n):
+        response = Response('press', limit=('z', '/'))
+        response.ref_time = 2.0
+        response.response = 'z' if i % 2 else '/'
+        response.rt = 0.4 + (i % 10) * 0.01
+        trial = Trial([])
+        trial.log.update({'trial_start': i * 4.0, 'face': ':-)',
+                          'subject': 'bench', 'press': response})
+        trials.append(trial)
+    return trials
+
+
+def time_log(trials):
+    stim_control = StimController(trials, HeadlessVisionEgg())
+    start = timer()
+    stim_control.loglines()
+    loglines_time = timer() - start
+
+    devnull = open(os.devnull, 'w')
+    start = timer()
+    stim_control.writelog(devnull)
+    writelog_time = timer() - start
+    devnull.close()
+
+    return {'loglines_s': loglines_time, 'writelog_s': writelog_time}
+
+
+def run(quick=False):
+    if quick:
+        sizes = (1, 10, 50)
+        stim_sizes = (10, 1000)
+        log_sizes = (1000, 10000)
+        picture_sizes = (20, )
+    else:
+        sizes = (1, 10, 50, 200, 500)
+        stim_sizes = (10, 100, 1000, 5000)
+        log_sizes = (10000, 100000)
+        picture_sizes = (20, 100)
+
+    frame_benchmarks = (('events', events_trials),
+                        ('overlap', overlap_trials),
+                        ('ref_depth', ref_depth_trials),
+                        ('pending', pending_trials))
+
+    results = []
+    for name, make_trials in frame_benchmarks:
+        for n in sizes:
+            record = {'benchmark': name, 'param': n}
+            record.update(summarize(time_frames(make_trials(n))))
+            results.append(record)
+            print >> sys.stderr, '%(benchmark)s %(param)d: ' \
+                  '%(mean_us).1f us/frame (max %(max_us).1f)' % record
+
+    for cull in (False, True):
+        for n in stim_sizes:
+            stimuli, trials = stimuli_trials(n)
+            record = {'benchmark': 'stimuli_cull' if cull else 'stimuli',
+                      'param': n}
+            record.update(summarize(time_frames(trials, stimuli=stimuli,
+                                                cull=cull)))
+            results.append(record)
+            print >> sys.stderr, '%(benchmark)s %(param)d: ' \
+                  '%(mean_us).1f us/frame (max %(max_us).1f)' % record
+
+    for cache in (False, True):
+        for n in picture_sizes:
+            record = {'benchmark': 'textures' if cache else 'textures_eager',
+                      'param': n}
+            record.update(time_textures(n, cache))
+            results.append(record)
+            print >> sys.stderr, '%(benchmark)s %(param)d: startup ' \
+                  '%(startup_s).3f s, %(mean_us).1f us/frame (max ' \
+                  '%(max_us).1f), %(misses)d misses' % record
+
+    for n in log_sizes:
+        record = {'benchmark': 'log', 'param': n}
+        record.update(time_log(logged_trials(n)))
+        results.append(record)
+        print >> sys.stderr, 'log %(param)d: loglines %(loglines_s).2f s, ' \
+              'writelog %(writelog_s).2f s' % record
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'frame_rate': FRAME_RATE,
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output',
+                      help='write JSON results here instead of stdout')
+    parser.add_option('-q', '--quick', action='store_true', default=False,
+                      help='smaller sizes, for a quick check')
+    options, args = parser.parse_args()
+
+    report = run(options.quick)
+    if options.output:
+        out = open(options.output, 'w')
+    else:
+        out = sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
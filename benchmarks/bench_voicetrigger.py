@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""Compare voice trigger detectors (see cognac.VoiceDetection) on recordings.
+
+Each WAV file (16 bit mono) is fed through each detector in chunks, as
+VoiceTriggerController would, with the same TriggerDebouncer settings.  If a
+labels file is given, triggers are scored against it:
+
+    hits        - labelled onsets with a trigger within --tolerance of them
+    misses      - labelled onsets without
+    false       - triggers that aren't near any labelled onset
+    onset_error - trigger minus labelled onset (ms) for the hits
+
+The labels file is CSV with a line for each onset: wav file name (no
+directory), onset in seconds.  We also report the CPU time per chunk.
+
+To make a noisy test recording (with hum, hiss and some "utterances") along
+with its labels:
+
+    python bench_voicetrigger.py --make-fixture noisy.wav
+
+then:
+
+    python bench_voicetrigger.py -l noisy.csv -o results.json noisy.wav
+
+tests/data/speech.wav is a short real recording of speech, labelled in
+tests/data/speech.csv.
+
+With --controller, the recordings go through a whole VoiceTriggerController
+instead (from a WavSource, as fast as possible - see cognac.AudioSource),
+timing each read_stream, and also reporting the detection latency: how long
+after each labelled onset its trigger event was posted.  --synthetic runs it
+on a SyntheticSource, with utterances at known onsets, so no files are
+needed.  --channels gives it more than one channel; the same utterances are
+then also run on one channel, as a baseline, and the cost per chunk of each
+detector is printed for both.  This mode needs VisionEgg (but no display or
+sound hardware).
+"""
+
+import sys
+import os
+import csv
+import json
+import time
+import wave
+import platform
+from timeit import default_timer as timer
+from functools import partial
+from optparse import OptionParser
+
+import numpy as np
+
+from cognac.VoiceDetection import TriggerDebouncer, PeakDetector, \
+                                  EnergyDetector
+
+
+def read_wav(fname):
+    wf = wave.open(fname, 'rb')
+    if wf.getnchannels() != 1 or wf.getsampwidth() != 2:
+        raise ValueError('%s is not 16 bit mono' % fname)
+    rate = wf.getframerate()
+    samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2')
+    wf.close()
+    return samples, rate
+
+
+def read_labels(fname):
+    labels = {}
+    for row in csv.reader(open(fname)):
+        if row and not row[0].startswith('#'):
+            labels.setdefault(row[0].strip(), []).append(float(row[1]))
+    return labels
+
+
+def make_fixture(fname, duration=20.0, rate=44100, seed=0):
+    """Write a noisy recording to fname, and its onsets to fname with .csv
+    for .wav"""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(duration * rate)) / float(rate)
+    # mains hum and its harmonic, plus hiss
+    sig = 1500 * np.sin(2 * np.pi * 60 * t) + \
+          500 * np.sin(2 * np.pi * 120 * t) + \
+          rng.normal(0, 150, len(t))
+
+    onsets = np.arange(1.5, duration - 1, 2.5) + rng.uniform(0, 0.5)
+    for i, onset in enumerate(onsets):
+        length = rng.uniform(0.3, 0.8)
+        start, stop = int(onset * rate), int((onset + length) * rate)
+        tt = t[start:stop] - onset
+        # A voiced sound: harmonics of a varying pitch, with a smooth
+        # envelope, getting quieter through the file
+        f0 = rng.uniform(100, 220)
+        voice = sum(np.sin(2 * np.pi * f0 * h * tt) / h for h in range(1, 8))
+        envelope = np.minimum(1, tt / 0.02) * np.hanning(len(tt)) ** 0.25
+        sig[start:stop] += (1200 - 40 * i) * voice * envelope
+
+    sig = np.clip(sig, -32768, 32767).astype('<i2')
+    wf = wave.open(fname, 'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(sig.tostring())
+    wf.close()
+
+    out = csv.writer(open(os.path.splitext(fname)[0] + '.csv', 'w'))
+    for onset in onsets:
+        out.writerow([os.path.basename(fname), '%.4f' % onset])
+
+
+def run_detector(detector, samples, rate, chunk_size, debounce):
+    """Returns a list of onset times, and the CPU time for each chunk"""
+    debouncer = TriggerDebouncer(rate, **debounce)
+    onsets = []
+    times = []
+    for start in range(0, len(samples) - chunk_size + 1, chunk_size):
+        chunk = samples[start:start + chunk_size]
+        began = timer()
+        speaking = debouncer.state != TriggerDebouncer.QUIET
+        signal, onset_thr, offset_thr = detector.process(chunk, speaking)
+        triggers = debouncer.update(signal, start, onset_thr, offset_thr)
+        times.append(timer() - began)
+        onsets.extend(float(trig[1]) / rate for trig in triggers
+                      if trig[0] == 'onset')
+    return onsets, times
+
+
+def run_controller(source, detector, options, debounce):
+    """Run source through a VoiceTriggerController in blocking mode, returning
+    a list of onset times, the times their events were posted (both in
+    seconds of audio), and the CPU time for each read_stream."""
+    import pygame
+    from cognac.VoiceTrigger import VoiceTriggerController, \
+                                    VOICE_TRIGGER_EVENT
+    from cognac.HeadlessVisionEgg import SimulatedEventQueue
+
+    vc = VoiceTriggerController(rec_duration=0.5, threshold=options.threshold,
+                                chunk_size=options.chunk_size,
+                                rate=source.rate, detector=detector,
+                                source=source, channels=source.channels,
+                                **debounce)
+    onsets = []
+    posted = []
+    times = []
+    queue = SimulatedEventQueue()
+    real_event = pygame.event
+    pygame.event = queue
+    try:
+        while not source.finished:
+            began = timer()
+            vc.read_stream()
+            times.append(timer() - began)
+            for event in queue.get(VOICE_TRIGGER_EVENT):
+                onsets.append(float(event.sample) / source.rate)
+                posted.append(float(vc.samples_written) / source.rate)
+    finally:
+        pygame.event = real_event
+        vc.close()
+    return onsets, posted, times
+
+
+def score(onsets, labels, tolerance, posted=None):
+    """Match each labelled onset with the nearest trigger"""
+    record = {'triggers': len(onsets)}
+    if labels is None:
+        return record
+
+    onsets = np.asarray(onsets)
+    matched = set()
+    errors = []
+    latencies = []
+    for label in labels:
+        if len(onsets):
+            nearest = np.abs(onsets - label).argmin()
+            if abs(onsets[nearest] - label) <= tolerance and \
+                    nearest not in matched:
+                matched.add(nearest)
+                errors.append(1000 * (onsets[nearest] - label))
+                if posted is not None:
+                    latencies.append(1000 * (posted[nearest] - label))
+    record.update({'hits': len(errors),
+                   'misses': len(labels) - len(errors),
+                   'false': len(onsets) - len(matched)})
+    if errors:
+        record['onset_error_ms_mean'] = float(np.mean(errors))
+        record['onset_error_ms_max'] = float(np.max(np.abs(errors)))
+    if latencies:
+        record['latency_ms_mean'] = float(np.mean(latencies))
+        record['latency_ms_max'] = float(np.max(latencies))
+    return record
+
+
+def report_line(record):
+    print >> sys.stderr, '%s %s: %d triggers, %s hits, %s false, ' \
+          '%.1f us/chunk' % (os.path.basename(record['file']),
+                             record['detector'], record['triggers'],
+                             record.get('hits', '-'),
+                             record.get('false', '-'),
+                             record['us_per_chunk'])
+
+
+def run_controllers(sources, options, debounce):
+    """sources is a list of (name, function making the source, labels)"""
+    results = []
+    for fname, make_source, labels in sources:
+        for name, detector in (('peak', None), ('energy', 'energy')):
+            source = make_source()
+            onsets, posted, times = run_controller(source, detector,
+                                                   options, debounce)
+            record = {'file': fname, 'detector': name, 'controller': True,
+                      'channels': source.channels}
+            record.update(score(onsets, labels, options.tolerance, posted))
+            record['us_per_chunk'] = 1e6 * sum(times) / max(len(times), 1)
+            results.append(record)
+            report_line(record)
+    return results
+
+
+def compare_channels(results, channels):
+    """Print the cost per chunk of each detector on the synthetic source with
+    channels channels, next to its cost on one"""
+    cost = dict(((r['file'], r['detector']), r['us_per_chunk'])
+                for r in results)
+    for name in ('peak', 'energy'):
+        mono = cost[('synthetic-1', name)]
+        multi = cost[('synthetic-%d' % channels, name)]
+        print >> sys.stderr, '%s: %.1f us/chunk on 1 channel, %.1f on %d ' \
+              '(%.2f times)' % (name, mono, multi, channels,
+                                multi / max(mono, 1e-9))
+
+
+def run(wav_files, labels, options):
+    debounce = {'min_duration': options.min_duration,
+                'offset_hold': options.offset_hold,
+                'refractory': options.refractory}
+    if options.controller or options.synthetic:
+        from cognac.AudioSource import WavSource, SyntheticSource
+        sources = [(fname, lambda fname=fname: WavSource(fname, False),
+                    labels.get(os.path.basename(fname))
+                    if labels is not None else None)
+                   for fname in wav_files]
+        if options.synthetic:
+            onsets = np.arange(1.0, options.synthetic - 1, 2.5)
+            # with more than one, the same utterances on one channel too, as
+            # a baseline
+            for channels in sorted(set([1, options.channels])):
+                # taking turns on each channel
+                utterances = [(onset, 0.5, 3000, i % channels)
+                              for i, onset in enumerate(onsets)]
+                sources.append(('synthetic-%d' % channels,
+                                partial(SyntheticSource,
+                                        utterances=utterances,
+                                        duration=options.synthetic,
+                                        channels=channels),
+                                list(onsets)))
+        results = run_controllers(sources, options, debounce)
+        if options.synthetic and options.channels > 1:
+            compare_channels(results, options.channels)
+        wav_files = []
+    else:
+        results = []
+
+    for fname in wav_files:
+        samples, rate = read_wav(fname)
+        detectors = (('peak', PeakDetector(options.threshold)),
+                     ('energy', EnergyDetector(rate)))
+        for name, detector in detectors:
+            onsets, times = run_detector(detector, samples, rate,
+                                         options.chunk_size, debounce)
+            record = {'file': fname, 'detector': name}
+            record.update(score(onsets, labels.get(os.path.basename(fname))
+                                if labels is not None else None,
+                                options.tolerance))
+            record['us_per_chunk'] = 1e6 * sum(times) / max(len(times), 1)
+            results.append(record)
+            report_line(record)
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'chunk_size': options.chunk_size,
+            'threshold': options.threshold,
+            'debounce': debounce,
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] file.wav ...')
+    parser.add_option('-o', '--output',
+                      help='write JSON results here instead of stdout')
+    parser.add_option('-l', '--labels',
+                      help='CSV of labelled onsets: wav file, seconds')
+    parser.add_option('--make-fixture', metavar='WAV',
+                      help='write a synthetic noisy recording (and labels) '
+                           'and exit')
+    parser.add_option('-t', '--threshold', type='int', default=1000,
+                      help='threshold for the peak detector [%default]')
+    parser.add_option('-c', '--chunk-size', type='int', default=800,
+                      help='samples per chunk [%default]')
+    parser.add_option('--tolerance', type='float', default=0.1,
+                      help='max seconds from a labelled onset for a hit '
+                           '[%default]')
+    parser.add_option('--controller', action='store_true', default=False,
+                      help='run the files through VoiceTriggerController')
+    parser.add_option('--synthetic', type='float', metavar='SECONDS',
+                      help='run a synthetic source of this length through '
+                           'VoiceTriggerController')
+    parser.add_option('--channels', type='int', default=1,
+                      help='channels for --synthetic [%default]')
+    parser.add_option('--min-duration', type='float', default=0.05)
+    parser.add_option('--offset-hold', type='float', default=0.15)
+    parser.add_option('--refractory', type='float', default=0.2)
+    options, args = parser.parse_args()
+
+    if options.make_fixture:
+        make_fixture(options.make_fixture)
+        sys.exit()
+    if not args and not options.synthetic:
+        parser.error('no WAV files given')
+
+    labels = None
+    if options.labels:
+        labels = read_labels(options.labels)
+
+    report = run(args, labels, options)
+    if options.output:
+        out = open(options.output, 'w')
+    else:
+        out = sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
@@ -15,7 +15,7 @@ from pygame.locals import K_5
 import yaml
 
 # local imports
-from SimpleVisionEgg import MultiStim
+from SimpleVisionEgg import MultiStim, onsets_offsets
 
 #################################
 # Set some VisionEgg Defaults:  #
@@ -194,49 +194,5 @@ class TRStimController:
         response = self.keyboard_controller.get_responses_since_go()
         responseTime = self.keyboard_controller.get_time_responses_since_go()
 
-        # If I've only got one item in my response list, then it's silly to worry about onset/offset.  Just keep it.
-        if len(response) < 2:
-            return (response,responseTime)
-        
-        # Save the first response, as by definition that's the first onset:
-        goodResp = [response[0]]
-        goodRespTime = [responseTime[0]-timeToSubtract]
-
-        # Now step through every other item in the response list to check for unique-ness.
-        for i in range(1,len(responseTime)):
-
-            if (not(response[i] == response[i-1]) or \
-                    (responseTime[i] - responseTime[i-1] > \
-                         min_interval)):
-                # ie, if something changed, or we have a long gap:
-                
-                offsetResp = [] # we might want to save an offset
-                for item in response[i-1]: # loop through last item's data
-                    if (responseTime[i] - responseTime[i-1] < \
-                            min_interval) and \
-                            not(item in response[i]):
-                        # Bit clunky.  Basically, holding down a key while pressing another creates
-                        # a unique response.  So if you only let up one of those keys, code the
-                        # offset just for that key.
-                        offsetResp.append(item+'_Off')
-                    else:
-                        # it's been long enough that everything that was on should be called off.
-                        offsetResp.append(item+'_Off')
-
-                if len(offsetResp) > 0:
-                    # If there's offset stuff to worry about, save it.
-                    goodResp.append(offsetResp)
-                    goodRespTime.append(responseTime[i-1]-timeToSubtract)
-                
-                # Save the new (onset) response.
-                goodResp.append(response[i])
-                goodRespTime.append(responseTime[i]-timeToSubtract)
-
-        # The final event should be an offset for whatever was down.
-        offsetResp = []
-        for item in response[-1]:
-            offsetResp.append(item+'_Off')
-        goodResp.append(offsetResp) #goodResp.append(response[-1]+'_Off')
-        goodRespTime.append(responseTime[-1]-timeToSubtract)
-
-        return (goodResp, goodRespTime)
+        return onsets_offsets(response, responseTime, timeToSubtract,
+                              min_interval)
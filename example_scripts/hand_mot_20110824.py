@@ -21,8 +21,9 @@ from VisionEgg.Text import Text
 from VisionEgg.WrappedText import WrappedText
 from VisionEgg.Textures import Texture, TextureStimulus
 import ExptHelpers as EH
-from StimController import Response, Event, Trial, StimController
-from SimpleVisionEgg import *
+from cognac.StimController import Response, Event, Trial, StimController
+from cognac.TextureCache import TextureCache
+from cognac.SimpleVisionEgg import *
 
 # get information from subject before initializing vision egg
 # global variables for experiment condition coding
@@ -49,6 +50,9 @@ fixation = Text(text = "+", font_size = 55, **std_params)
 blank = Text(text = "", **std_params)
 rest_screen = Text(text = "Press SPACE to continue.", **std_params)
 
+# keep up to 256 MB of pictures, loading 3 trials ahead
+texture_cache = TextureCache(memory_budget=256 * 2**20, lookahead=3)
+
 ###########################
 # A couple useful classes #
 ###########################
@@ -60,10 +64,11 @@ class PicStim(TextureStimulus):
         self.motiv = picname[0]
         self.valen = picname[2]
 
-        texture = Texture(STIM_DIRECTORY + picname)  # load the picture
+        # the picture is loaded by texture_cache when it's needed
+        self.texture_file = STIM_DIRECTORY + picname
 
         TextureStimulus.__init__(self,
-            texture = texture,
+            texture = texture_cache.placeholder(),
             size = (500, 400), 
             **std_params)
 
@@ -137,7 +142,8 @@ exp_stimuli = [rest_screen, fixation, blank, switch_inst.stim] + \
 vision_egg.set_stimuli(exp_stimuli)
 #stim_control = StimController(all_trials,
     #vision_egg, pause_event = Event(rest_screen, 0, 0))
-stim_control = StimController(all_trials, vision_egg)
+stim_control = StimController(all_trials, vision_egg,
+                              texture_cache=texture_cache)
 
 stim_control.run_trials(len(all_trials))
 stim_control.writelog(stim_control.getOutputFilename(SUBJECT, 'MotivHand'))
@@ -0,0 +1,45 @@
+'''
+Smoke tests for the benchmarks - each is run as a script, as on a headless CI
+box (no display is initialized), and should give a result for everything.
+
+    python -m unittest discover tests
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks')
+
+
+def run_benchmark(script, *args):
+    ''' Run script from benchmarks with args, returning its JSON report '''
+    directory = tempfile.mkdtemp()
+    try:
+        output = os.path.join(directory, 'results.json')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.check_call([sys.executable,
+                               os.path.join(BENCHMARKS, script), '-o',
+                               output] + list(args), env=env)
+        return json.load(open(output))
+    finally:
+        shutil.rmtree(directory)
+
+
+class BenchStimControllerTest(unittest.TestCase):
+
+    def test_quick(self):
+        report = run_benchmark('bench_stimcontroller.py', '-q')
+        benchmarks = set(r['benchmark'] for r in report['results'])
+        for name in ('events', 'overlap', 'ref_depth', 'pending', 'stimuli',
+                     'stimuli_cull', 'textures', 'textures_eager'):
+            self.assertTrue(name in benchmarks, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,432 @@
+'''
+Tests for StimController, run headless (see cognac.HeadlessVisionEgg).
+
+    python -m unittest discover tests
+'''
+
+import os
+import json
+import errno
+import time
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from timeit import default_timer as clock
+
+import pygame
+
+from cognac.StimController import Event, Trial, Response, StimController, \
+    merge_log, FrameTimer, InputDispatcher, InputThread, EvdevSource, key_code, key_name
+from cognac.HeadlessVisionEgg import HeadlessVisionEgg, HeadlessStimulus, \
+    SimulatedResponder, SimulatedEventQueue
+
+
+def make_trials(n):
+    stim = HeadlessStimulus()
+    trials = []
+    for i in range(n):
+        trial = Trial([Event(stim, start=0, duration=0.05)])
+        trial.log['number'] = i
+        trials.append(trial)
+    return trials
+
+
+class LogStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'log.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def merged(self):
+        out = StringIO()
+        merge_log(self.fname, out)
+        return out.getvalue()
+
+    def written(self, stim_control):
+        out = StringIO()
+        stim_control.writelog(out)
+        return out.getvalue()
+
+    def test_complete_run(self):
+        stim_control = StimController(make_trials(5), HeadlessVisionEgg(),
+                                      log_stream=self.fname)
+        stim_control.run_trials('all')
+        self.assertEqual(len(open(self.fname).readlines()), 5)
+        self.assertEqual(self.merged(), self.written(stim_control))
+
+    def test_blocks(self):
+        # Each block is on disk once run_trials returns
+        stim_control = StimController(make_trials(6), HeadlessVisionEgg(),
+                                      log_stream=self.fname)
+        stim_control.run_trials(4)
+        self.assertEqual(len(open(self.fname).readlines()), 4)
+        stim_control.run_trials(2)
+        self.assertEqual(len(open(self.fname).readlines()), 6)
+        self.assertEqual(self.merged(), self.written(stim_control))
+
+    def test_crash(self):
+        # Trials that finished before a crash are in the log
+        class Crash(Exception):
+            pass
+
+        def respond(t, event_queue):
+            if stim_control.trial_index == 7:
+                raise Crash
+        stim_control = StimController(make_trials(11),
+                                      HeadlessVisionEgg(respond=respond),
+                                      log_stream=self.fname)
+        self.assertRaises(Crash, stim_control.run_trials, 'all')
+        lines = open(self.fname).readlines()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual([json.loads(line)['number'] for line in lines],
+                         range(7))
+
+
+class EventTest(unittest.TestCase):
+
+    def test_parms_changed_between_activations(self):
+        # As the example scripts do between trials
+        stim = HeadlessStimulus()
+        event = Event(stim, start=0, duration=1, text='first')
+        event.activate()
+        self.assertEqual(stim.parameters.text, 'first')
+        event.parms['text'] = 'second'
+        event.activate()
+        self.assertEqual(stim.parameters.text, 'second')
+        event.parms = {'on': True, 'text': 'third'}
+        event.activate()
+        self.assertEqual(stim.parameters.text, 'third')
+
+    def test_hooks(self):
+        class Hook:
+            def __init__(self):
+                self.calls = []
+            def activated(self, target):
+                self.calls.append(('activated', target))
+            def deactivated(self, target):
+                self.calls.append(('deactivated', target))
+        stim = HeadlessStimulus()
+        event = Event(stim, start=0, duration=1)
+        hook = Hook()
+        event.activate([hook])
+        event.deactivate([hook])
+        self.assertEqual(hook.calls, [('activated', stim),
+                                      ('deactivated', stim)])
+
+
+def run_timeline(trial, respond=None, frame_rate=100.0, max_t=6.0):
+    ''' Run trial headless, returning {stim: (t it went on, t it went off)},
+    with None for anything that didn't happen by max_t '''
+    vision_egg = HeadlessVisionEgg(frame_rate, respond)
+    stim_control = StimController([trial], vision_egg)
+    stims = set(event.target for event in trial.events)
+    times = dict((stim, [None, None]) for stim in stims)
+    update = stim_control.update
+    def update_and_look(t):
+        update(t)
+        for stim in stims:
+            on_off = times[stim]
+            if stim.parameters.on and on_off[0] is None:
+                on_off[0] = t
+            elif not stim.parameters.on and on_off[0] is not None and \
+                    on_off[1] is None:
+                on_off[1] = t
+        if t >= max_t:
+            vision_egg.pause()
+    vision_egg.set_functions(update=update_and_look,
+                             pause_update=stim_control.pause_update)
+    stim_control.run_trials('all')
+    return dict((stim, tuple(on_off)) for stim, on_off in times.items())
+
+
+class TimelineTest(unittest.TestCase):
+
+    def assertTimes(self, got, expected):
+        # to the frame (0.2 + 0.1 can come out a hair over 0.3)
+        for (on, off), (expected_on, expected_off) in zip(got, expected):
+            self.assertAlmostEqual(on, expected_on, delta=0.0101)
+            self.assertAlmostEqual(off, expected_off, delta=0.0101)
+
+    def test_out_of_order_starts(self):
+        a, b, c = [HeadlessStimulus() for i in range(3)]
+        trial = Trial([Event(a, start=0.3, duration=0.1),
+                       Event(b, start=0, duration=0.1),
+                       Event(c, start=0.1, duration=0.5)])
+        times = run_timeline(trial)
+        self.assertTrue(trial.done())
+        self.assertTimes([times[a], times[b], times[c]],
+                         [(0.3, 0.4), (0, 0.1), (0.1, 0.6)])
+
+    def test_stop_on_logged_key(self):
+        # Nothing starts on cue, it's only used to stop b
+        a, b = HeadlessStimulus(), HeadlessStimulus()
+        trial = Trial([Event(a, start=0, duration=0.1, log={'cue': 0.2}),
+                       Event(b, start=0, stop='cue+0.1')])
+        times = run_timeline(trial)
+        self.assertTrue(trial.done())
+        self.assertTimes([times[b]], [(0, 0.3)])
+
+    def test_stop_on_trial_start(self):
+        # Nothing starts on trial_start, it's only used to stop b
+        a, b = HeadlessStimulus(), HeadlessStimulus()
+        trial = Trial([Event(a, start=('cue', 0), duration=0.1),
+                       Event(b, start=('cue', 0.1), stop='trial_start+0.5')])
+        trial.log['cue'] = 0.2
+        times = run_timeline(trial)
+        self.assertTrue(trial.done())
+        self.assertTimes([times[a], times[b]], [(0.2, 0.3), (0.3, 0.5)])
+
+    def test_response_refs(self):
+        def respond(t, event_queue):
+            if abs(t - 0.45) < 1e-9:
+                event_queue.post(event_queue.Event(pygame.KEYDOWN,
+                                                   key=pygame.K_SPACE))
+        a, b, c = [HeadlessStimulus() for i in range(3)]
+        response = Response('resp')
+        trial = Trial([Event(a, start=0.2, duration=1, response=response,
+                             on_keypress=True),
+                       Event(b, start='resp+0.1', duration=0.2),
+                       Event(c, start=0, stop='resp+0.05')])
+        times = run_timeline(trial, respond)
+        self.assertTrue(trial.done())
+        self.assertAlmostEqual(response.rt, 0.25)
+        self.assertTimes([times[a], times[b], times[c]],
+                         [(0.2, 0.46), (0.55, 0.75), (0, 0.5)])
+
+    def test_log_key_set_later(self):
+        a = HeadlessStimulus()
+        trial = Trial([Event(a, start='soa', duration=0.1)])
+        trial.log['soa'] = 0.25
+        times = run_timeline(trial)
+        self.assertTrue(trial.done())
+        self.assertTimes([times[a]], [(0.25, 0.35)])
+
+    def test_unknown_ref(self):
+        trial = Trial([Event(HeadlessStimulus(), start='soa', duration=0.1)])
+        self.assertRaises(ValueError, run_timeline, trial)
+
+    def test_cycle(self):
+        self.assertRaises(ValueError, Trial, [
+            Event(HeadlessStimulus(), start='b', duration=0.1, log={'a': 0}),
+            Event(HeadlessStimulus(), start='a', duration=0.1, log={'b': 0})])
+
+
+class FrameTimerTest(unittest.TestCase):
+
+    def test_blocks(self):
+        # t starts over with each run_trials (each go)
+        frame_timer = FrameTimer()
+        stim_control = StimController(make_trials(4), HeadlessVisionEgg(),
+                                      frame_timer=frame_timer)
+        stim_control.run_trials(2)
+        stim_control.run_trials(2)
+        frames = list(frame_timer.frames())
+        intervals = [frame[2] for frame in frames]
+        self.assertTrue(min(intervals) >= 0, intervals)
+        # The first frame of each go has no interval
+        firsts = [i for i, frame in enumerate(frames) if frame[1] == 0]
+        self.assertEqual(len(firsts), 2)
+        self.assertEqual([intervals[i] for i in firsts], [0.0, 0.0])
+
+
+class KeyNameTest(unittest.TestCase):
+    ''' Without a display (as here), pygame.key.name doesn't know any names
+    '''
+
+    def test_round_trip(self):
+        for name in ('space', 'a', '1', '/', 'return', 'left shift', '[0]'):
+            self.assertEqual(key_name(key_code(name)), name)
+        self.assertEqual(key_code('space'), pygame.K_SPACE)
+        self.assertRaises(KeyError, key_code, 'no such key')
+
+    def test_simulated_responses(self):
+        stim = HeadlessStimulus()
+        trials = [Trial([Event(stim, start=0, duration=1,
+                               response=Response('resp', limit=('f', 'j')),
+                               on_keypress=True)]) for i in range(2)]
+        vision_egg = HeadlessVisionEgg()
+        stim_control = StimController(trials, vision_egg)
+        vision_egg.respond = SimulatedResponder(stim_control, rt=0.2, key='j')
+        stim_control.run_trials('all')
+        for trial in trials:
+            self.assertEqual(trial.log['resp'].response, 'j')
+            self.assertAlmostEqual(trial.log['resp'].rt, 0.2, delta=0.02)
+
+
+class CullingTest(unittest.TestCase):
+
+    def run_pictures(self, vision_egg, stims):
+        trials = [Trial([Event(s, start=0, duration=0.05)]) for s in stims]
+        seen = []
+        stim_control = StimController(trials, vision_egg)
+        update = stim_control.update
+        def update_and_look(t):
+            update(t)
+            seen.append(list(vision_egg.viewport.parameters.stimuli))
+        vision_egg.set_functions(update=update_and_look,
+                                 pause_update=stim_control.pause_update)
+        stim_control.run_trials('all')
+        return seen
+
+    def test_set_stimuli_again(self):
+        stims = [HeadlessStimulus() for i in range(3)]
+        vision_egg = HeadlessVisionEgg()
+        vision_egg.set_stimuli(stims, cull=True)
+        old = vision_egg.active_stimuli
+        vision_egg.set_stimuli(stims, cull=True)
+        seen = self.run_pictures(vision_egg, stims)
+        self.assertEqual(seen[0], stims[:1])
+        self.assertEqual(old.active, set())
+
+    def test_other_vision_egg(self):
+        stims = [HeadlessStimulus() for i in range(3)]
+        other = HeadlessVisionEgg()
+        other.set_stimuli(stims, cull=True)
+        vision_egg = HeadlessVisionEgg()
+        vision_egg.set_stimuli(stims, cull=True)
+        self.run_pictures(vision_egg, stims)
+        self.assertEqual(other.active_stimuli.active, set())
+        self.assertEqual(other.viewport.parameters.stimuli, [])
+
+
+try:
+    import evdev
+except ImportError:
+    evdev = None
+
+
+class FakeDevice:
+    ''' Gives back events, as an evdev.InputDevice would '''
+
+    def __init__(self, events):
+        self.events = events
+
+    def read(self):
+        if not self.events:
+            raise IOError(errno.EAGAIN, 'Resource temporarily unavailable')
+        events, self.events = self.events, []
+        return iter(events)
+
+
+class InputThreadTest(unittest.TestCase):
+
+    def test_stop_straight_after_start(self):
+        for i in range(100):
+            thread = InputThread([])
+            thread.start()
+            # What stop() does, but with a join we can give up on
+            thread.running = False
+            thread.join(1.0)
+            alive = thread.is_alive()
+            thread.running = False
+            self.assertFalse(alive)
+
+
+class FakeInputThread:
+    ''' Hands out (clock time, event)s, as an InputThread would '''
+
+    def __init__(self):
+        self.events = []
+
+    def take(self):
+        events, self.events = self.events, []
+        return events
+
+
+class DuplicateKeyTest(unittest.TestCase):
+    ''' Key presses from an InputThread that pygame gives us again '''
+
+    def setUp(self):
+        self.input_thread = FakeInputThread()
+        self.dispatcher = InputDispatcher(input_thread=self.input_thread)
+        self.queue = SimulatedEventQueue()
+        self.real_event = pygame.event
+        pygame.event = self.queue
+
+    def tearDown(self):
+        pygame.event = self.real_event
+
+    def press(self, key, event_type=pygame.KEYDOWN):
+        return pygame.event.Event(event_type, key=key)
+
+    def drained(self, t):
+        self.dispatcher.drain(t)
+        return [(event.type, event.key) for stamp, event in
+                self.dispatcher.history if hasattr(event, 'key')]
+
+    def test_pygame_copies_dropped(self):
+        space, a = key_code('space'), key_code('a')
+        self.input_thread.events = [(clock(), self.press(space)),
+                                    (clock(), self.press(space,
+                                                         pygame.KEYUP))]
+        self.drained(0.0)
+        # a frame later, pygame has them (and a key only it saw)
+        for event in (self.press(space), self.press(space, pygame.KEYUP),
+                      self.press(a)):
+            self.queue.post(event)
+        self.assertEqual(self.drained(1 / 60.),
+                         [(pygame.KEYDOWN, space), (pygame.KEYUP, space),
+                          (pygame.KEYDOWN, a)])
+
+    def test_each_copy_matched_once(self):
+        space = key_code('space')
+        self.input_thread.events = [(clock(), self.press(space))]
+        self.drained(0.0)
+        # The second one is a real (second) press
+        self.queue.post(self.press(space))
+        self.queue.post(self.press(space))
+        self.assertEqual(len(self.drained(1 / 60.)), 2)
+
+    def test_old_presses_not_matched(self):
+        space = key_code('space')
+        self.input_thread.events = [(clock(), self.press(space))]
+        self.drained(0.0)
+        self.queue.post(self.press(space))
+        self.assertEqual(len(self.drained(1.0)), 2)
+
+
+def key_event(when, type, code, value):
+    sec, usec = divmod(int(1e6 * when), 10**6)
+    return evdev.InputEvent(sec, usec, type, code, value)
+
+
+@unittest.skipIf(evdev is None, 'needs evdev')
+class EvdevSourceTest(unittest.TestCase):
+
+    def test_kernel_times(self):
+        ecodes = evdev.ecodes
+        now = time.time()
+        # pressed 30 and released 20 ms ago, with an auto-repeat between
+        device = FakeDevice([
+            key_event(now - 0.03, ecodes.EV_KEY, ecodes.KEY_A, 1),
+            key_event(now - 0.025, ecodes.EV_KEY, ecodes.KEY_A, 2),
+            key_event(now - 0.02, ecodes.EV_KEY, ecodes.KEY_SPACE, 0),
+            key_event(now - 0.02, ecodes.EV_SYN, 0, 0),
+            ])
+
+        thread = InputThread([EvdevSource(device)])
+        thread.start()
+        try:
+            deadline = clock() + 1
+            while len(thread.events) < 2 and clock() < deadline:
+                time.sleep(0.001)
+        finally:
+            thread.stop()
+        polled = clock()
+        taken = thread.take()
+
+        self.assertEqual([(e.type, e.key) for s, e in taken],
+                         [(pygame.KEYDOWN, key_code('a')),
+                          (pygame.KEYUP, key_code('space'))])
+        # The kernel's times, not when we read them
+        stamps = [s for s, e in taken]
+        self.assertAlmostEqual(stamps[1] - stamps[0], 0.01, places=4)
+        self.assertTrue(stamps[1] < polled - 0.02 + 0.005)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+'''
+Tests for TextureCache, run headless with a fake loader.
+
+    python -m unittest discover tests
+'''
+
+import sys
+import time
+import unittest
+from cStringIO import StringIO
+
+from cognac.StimController import Event, Trial, StimController
+from cognac.HeadlessVisionEgg import HeadlessVisionEgg, HeadlessStimulus
+from cognac.TextureCache import TextureCache
+
+
+class FakeTexture:
+    size = (100, 100)  # 40000 bytes
+
+
+PLACEHOLDER = FakeTexture()
+
+
+class PictureStimulus(HeadlessStimulus):
+    ''' Counts its uploads, like a VisionEgg TextureStimulus would do them '''
+
+    def __init__(self, texture_file):
+        HeadlessStimulus.__init__(self, texture=PLACEHOLDER)
+        self.texture_file = texture_file
+        self.reloads = 0
+
+    def _reload_texture(self):
+        self.reloads += 1
+
+
+def fake_load(fname):
+    return FakeTexture()
+
+
+class TextureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pictures = [PictureStimulus('%d.png' % i) for i in range(20)]
+        self.trials = [Trial([Event(p, start=0, duration=0.05)])
+                       for p in self.pictures]
+
+    def make_cache(self, lookahead):
+        # room for 3 pictures
+        self.cache = TextureCache(3 * 40000, lookahead, loader=fake_load,
+                                  placeholder=PLACEHOLDER)
+        return self.cache
+
+    def loaded(self):
+        return [p for p in self.pictures
+                if p.parameters.texture is not PLACEHOLDER]
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_misses_stay_in_budget(self):
+        # Without looking ahead, every picture after the first is loaded on
+        # the main thread - and those must be dropped too
+        stim_control = StimController(self.trials, HeadlessVisionEgg(),
+                                      texture_cache=self.make_cache(0))
+        # Nothing's printed in the frames
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            stim_control.run_trials('all')
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(printed, '')
+        self.assertEqual(self.cache.misses, len(self.pictures) - 1)
+        self.assertEqual(len(self.cache.miss_times), self.cache.misses)
+        self.assertTrue(self.cache.bytes_used <= self.cache.memory_budget)
+        self.assertTrue(len(self.loaded()) <= 3)
+
+    def test_idle_uploads_only_new_textures(self):
+        cache = self.make_cache(1)
+        stim_control = StimController(self.trials[:2], HeadlessVisionEgg(),
+                                      texture_cache=cache)
+        give_up = time.time() + 5
+        while '1.png' not in cache.textures and time.time() < give_up:
+            time.sleep(0.01)
+        for i in range(5):
+            self.cache.idle()
+        self.assertEqual(self.pictures[1].reloads, 1)
+        self.assertTrue(self.pictures[1] in self.loaded())
+        # Decoded again (e.g., after a miss) - it already has it, so there's
+        # nothing to upload
+        cache.decoded.append(('1.png', []))
+        cache.idle()
+        self.assertEqual(self.pictures[1].reloads, 1)
+
+    def test_close(self):
+        def bad_load(fname):
+            raise IOError('no such file')
+        cache = self.make_cache(1)
+        cache.loader = bad_load
+        cache.prefetch(['missing.png'])
+        cache.close()
+        self.assertFalse(cache.thread.is_alive())
+        self.assertEqual([fname for fname, e in cache.load_errors],
+                         ['missing.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+'''
+Tests for cognac.VoiceDetection, on a real recording of speech (see
+tests/data/README).  The EnergyDetector tests need scipy.
+
+    python -m unittest discover tests
+'''
+
+import os
+import wave
+import unittest
+
+import numpy as np
+
+from cognac.VoiceDetection import TriggerDebouncer, PeakDetector, \
+    EnergyDetector, ChunkPeaks, chunk_peaks, calibrate_threshold
+
+try:
+    import scipy.signal
+except ImportError:
+    scipy = None
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
+# Labelled onset of the speech in speech.wav (seconds)
+SPEECH_ONSET = 0.25
+SPEECH_OFFSET = 2.77
+
+
+def read_speech():
+    wf = wave.open(os.path.join(DATA_DIRECTORY, 'speech.wav'), 'rb')
+    rate = wf.getframerate()
+    samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2')
+    wf.close()
+    return samples, rate
+
+
+def run_detector(detector, samples, rate, chunk_size=160):
+    ''' Feed samples through detector and a TriggerDebouncer in chunks, as
+    VoiceTriggerController does, returning the debouncer's events (in
+    seconds) '''
+    debouncer = TriggerDebouncer(rate, min_duration=0.05, offset_hold=0.15)
+    events = []
+    for start in range(0, len(samples), chunk_size):
+        signal, onset_threshold, offset_threshold = detector.process(
+            samples[start:start + chunk_size],
+            debouncer.state == debouncer.SPEAKING)
+        for event in debouncer.update(signal, start, onset_threshold,
+                                      offset_threshold):
+            events.append((event[0],) +
+                          tuple(float(s) / rate for s in event[1:]))
+    return events
+
+
+class ChunkPeaksTest(unittest.TestCase):
+
+    def test_pieces(self):
+        samples = np.arange(10)
+        peaks = ChunkPeaks(4)
+        got = [peaks.update(samples[:3]), peaks.update(samples[3:9]),
+               peaks.update(samples[9:]), peaks.flush()]
+        self.assertEqual([list(p) for p in got], [[], [3, 7], [], [9]])
+        self.assertEqual(list(peaks.flush()), [])
+
+    def test_tail_is_kept(self):
+        # The loudest sample is in the last, partial chunk
+        samples = np.zeros(1000, dtype=np.int16)
+        samples[-1] = 5000
+        self.assertEqual(list(chunk_peaks(samples, 800)), [0, 5000])
+        self.assertEqual(list(chunk_peaks(samples[-10:], 800)), [5000])
+
+
+class RecordedSpeechTest(unittest.TestCase):
+
+    def setUp(self):
+        self.speech, self.rate = read_speech()
+        # A second of noise like the recording's own lead-in first, so the
+        # detectors have a noise floor to go on
+        lead_in = self.speech[:int(0.2 * self.rate)]
+        rng = np.random.RandomState(0)
+        self.noise = rng.normal(0, lead_in.std(), self.rate).astype(np.int16)
+        self.samples = np.concatenate([self.noise, self.speech])
+
+    def assertOnsets(self, events, onsets):
+        found = [event[1] - 1 for event in events if event[0] == 'onset']
+        self.assertEqual(len(found), len(onsets), events)
+        for got, expected in zip(found, onsets):
+            self.assertAlmostEqual(got, expected, delta=0.05)
+
+    def test_calibrated_peak_detector(self):
+        threshold, stats = calibrate_threshold(self.noise, self.speech,
+                                               chunk_size=160)
+        self.assertTrue(stats['speech_over_threshold'] > 0.2, stats)
+        self.assertTrue(stats['noise_over_threshold'] < 0.05, stats)
+        events = run_detector(PeakDetector(threshold), self.samples,
+                              self.rate)
+        self.assertOnsets(events, [SPEECH_ONSET])
+
+    @unittest.skipIf(scipy is None, 'needs scipy')
+    def test_energy_detector(self):
+        events = run_detector(EnergyDetector(self.rate), self.samples,
+                              self.rate)
+        self.assertOnsets(events, [SPEECH_ONSET])
+        offsets = [event[2] - 1 for event in events if event[0] == 'offset']
+        self.assertEqual(len(offsets), 1)
+        self.assertAlmostEqual(offsets[0], SPEECH_OFFSET, delta=0.1)
+
+    @unittest.skipIf(scipy is None, 'needs scipy')
+    def test_integer_noise_time(self):
+        # The noise floor should move the same whatever type noise_time is
+        thresholds = []
+        for noise_time in (1, 1.0):
+            detector = EnergyDetector(self.rate, noise_time=noise_time)
+            # quieter than the noise it'll start from
+            run_detector(detector, self.noise / 4, self.rate)
+            run_detector(detector, self.noise, self.rate)
+            thresholds.append(detector.thresholds())
+        self.assertAlmostEqual(thresholds[0][0], thresholds[1][0])
+        self.assertAlmostEqual(thresholds[0][1], thresholds[1][1])
@@ -0,0 +1,167 @@
+'''
+Tests for VoiceTriggerController, run on simulated audio sources (see
+cognac.AudioSource), so no sound hardware is needed.  Needs VisionEgg and
+pygame to be importable, like the rest of cognac.
+
+    python -m unittest discover tests
+'''
+
+import time
+import threading
+import unittest
+
+import numpy as np
+import pygame
+
+from cognac.AudioSource import SimulatedSource, SyntheticSource
+from cognac.VoiceTrigger import VoiceTriggerController, VOICE_TRIGGER_EVENT
+from cognac.HeadlessVisionEgg import SimulatedEventQueue
+
+
+def wait_for(condition, timeout=5.0):
+    ''' Poll condition until it's true, or timeout seconds have passed '''
+    give_up = time.time() + timeout
+    while not condition():
+        if time.time() > give_up:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class CallbackModeTest(unittest.TestCase):
+
+    def test_non_realtime_source(self):
+        # A non-realtime source calls back as fast as it can, starting at an
+        # ADC time of 0.0, which is a real time and not a missing one
+        source = SyntheticSource(duration=5.0, realtime=False)
+        vc = VoiceTriggerController(rec_duration=0.5, callback_mode=True,
+                                    source=source)
+        try:
+            self.assertTrue(wait_for(lambda: source.finished))
+            self.assertTrue(source.thread.is_alive())
+            self.assertTrue(vc.samples_written >= 5 * source.rate)
+            self.assertEqual(vc.sample_clock[0] % vc.CHUNK_SIZE, 0)
+        finally:
+            vc.close()
+
+
+class WatchedDetector(object):
+    ''' Passes the samples through, noting any calls that overlap, and the
+    calls made on the main thread '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inside = 0
+        self.overlaps = 0
+        self.main_thread_calls = []
+        self.vc = None
+
+    def process(self, chunk, speaking=False):
+        with self.lock:
+            self.inside += 1
+            if self.inside > 1:
+                self.overlaps += 1
+        if isinstance(threading.current_thread(), threading._MainThread):
+            self.main_thread_calls.append(self.vc.calibrating)
+        time.sleep(0.001)
+        with self.lock:
+            self.inside -= 1
+        return chunk, 1e6, 1e6
+
+
+class CalibrateTest(unittest.TestCase):
+
+    def test_priming_the_detector(self):
+        # In callback mode, the audio thread is using the detector too
+        detector = WatchedDetector()
+        source = SyntheticSource(duration=5.0, realtime=True)
+        vc = VoiceTriggerController(rec_duration=0.5, callback_mode=True,
+                                    detector=detector, source=source)
+        detector.vc = vc
+        try:
+            vc.calibrate(noise_duration=0.5, verbose=False)
+            time.sleep(0.2)
+        finally:
+            vc.close()
+        self.assertTrue(detector.main_thread_calls)
+        self.assertTrue(all(detector.main_thread_calls))
+        self.assertEqual(detector.overlaps, 0)
+
+
+class ThresholdGuiTest(unittest.TestCase):
+
+    def test_rejects_more_than_one_channel(self):
+        source = SyntheticSource(duration=1.0, channels=2)
+        vc = VoiceTriggerController(channels=2, threshold=[1000, 2000],
+                                    source=source)
+        try:
+            self.assertRaises(ValueError, vc.set_threshold_gui)
+        finally:
+            vc.close()
+
+
+def feed(vc, source, seconds):
+    ''' Hand seconds of source to vc's audio_callback, as the audio thread
+    would, chunk by chunk '''
+    n = vc.CHUNK_SIZE
+    for i in range(int(seconds * source.rate) // n):
+        start = source.position
+        chunk = source.next_chunk(n)
+        vc.audio_callback(chunk.astype('<i2').tostring(), n,
+                          {'input_buffer_adc_time':
+                               float(start) / source.rate}, 0)
+
+
+class RecordingTest(unittest.TestCase):
+    ''' Recordings in callback mode, fed by hand so we can leave out frames
+    (i.e., calls to check_trigger), as during a pause between trials '''
+
+    def setUp(self):
+        # an utterance at 1 s, then a long silence - much longer than the
+        # ring buffer
+        self.source = SyntheticSource(utterances=[(1.0, 0.5)], duration=20.,
+                                      hum=0, hiss=0)
+        # feed() plays the source's part, so it's opened in blocking mode,
+        # and never read
+        self.vc = VoiceTriggerController(rec_duration=1.0, pre_trigger=0.2,
+                                         source=SimulatedSource())
+        self.assertTrue(self.vc.ring.shape[0] < 10 * self.source.rate)
+        self.real_event = pygame.event
+        pygame.event = self.queue = SimulatedEventQueue()
+
+    def tearDown(self):
+        pygame.event = self.real_event
+        self.vc.close()
+
+    def check_clip(self):
+        ''' The one recording should start pre_trigger before the trigger '''
+        vc = self.vc
+        self.assertEqual(vc.clips.names, ['0.wav'])
+        self.assertEqual(vc.dropped_clips, [])
+        trigger, = self.queue.get(VOICE_TRIGGER_EVENT)
+        self.assertTrue(abs(trigger.sample - self.source.rate) < 0.01 *
+                        self.source.rate)
+        start = trigger.sample - int(vc.pre_trigger * vc.RATE)
+        clip = list(vc.clips.items())[0][1]
+        self.assertTrue(np.array_equal(
+            clip, self.source.samples(start, vc.rec_samples)))
+
+    def test_pause_after_trigger(self):
+        vc = self.vc
+        feed(vc, self.source, 1.1)
+        vc.check_trigger()  # the frame that sees the trigger
+        feed(vc, self.source, 10.0)  # no frames
+        vc.check_trigger()
+        self.check_clip()
+
+    def test_pause_before_trigger_is_seen(self):
+        # The trigger isn't looked at until after a pause longer than the
+        # ring buffer, but the recording (pre_trigger and all) is still there
+        vc = self.vc
+        feed(vc, self.source, 10.0)
+        vc.check_trigger()
+        self.check_clip()
+
+
+if __name__ == '__main__':
+    unittest.main()